@@ -256,10 +256,11 @@ def analytics_summary_api(
     ),  # строковый пресет
     date_from: Optional[str] = Query(None),  # явная нижняя граница
     date_to: Optional[str] = Query(None),  # явная верхняя граница
+    approx_users: bool = Query(False),  # пользователи через HyperLogLog
 ) -> Dict[str, Any]:  # JSON со счётчиками
     """Короткая сводка: всего/входящих/исходящих/пользователи."""
     dt_from, dt_to = _period_range(period, date_from, date_to)  # 🔴 границы
-    return get_analytics_summary(dt_from, dt_to)  # 🔴 единый расчёт
+    return get_analytics_summary(dt_from, dt_to, approx_users)  # 🔴 единый расчёт
 
 
 @router.get("/analytics/users")  # активность по пользователям
@@ -4,21 +4,31 @@
 from __future__ import annotations  # типы из будущего
 
 import os  # окружение и пути
-import json  # сериализация
+import asyncio  # очередь фоновой отправки
 import hmac  # подпись Chat API
 import hashlib  # MD5/HMAC
 import logging  # логи
+import functools  # lru_cache для строк чата
 from pathlib import Path  # путь к .env
 from typing import Optional  # типы
+from dataclasses import dataclass  # снимок настроек
 import aiohttp  # HTTP-клиент
+from multidict import CIMultiDict  # заголовки aiohttp без конвертации
+import orjson  # быстрый JSON → bytes
 import uuid
 import time
+from email.utils import formatdate  # RFC1123-дата для заголовка Date
 
 
 
 from dotenv import load_dotenv  # .env загрузчик
 
-from constants import AMO_REQUEST_TIMEOUT_SEC  # таймауты HTTP
+from constants import (  # таймауты HTTP и лимиты очередей
+    AMO_REQUEST_TIMEOUT_SEC,
+    CHAT_SEND_QUEUE_MAXSIZE,
+)
+
+logger = logging.getLogger(__name__)  # логгер модуля
 
 
 # ======================
@@ -37,10 +47,88 @@ AMO_REFRESH_TOKEN = os.getenv("AMO_REFRESH_TOKEN", "")  # refresh
 AMO_ACCESS_TOKEN = os.getenv("AMO_ACCESS_TOKEN", "")  # access
 AMO_PIPELINE_ID = os.getenv("AMO_PIPELINE_ID", "0")  # ID воронки
 
+
+def _int_env(name: str, default: int) -> int:
+    """Целое из окружения; мусор → default."""
+    try:
+        return int(os.getenv(name, str(default)))
+    except ValueError:
+        return default
+
+
+@dataclass(slots=True)
+class _Cfg:
+    """Снимок настроек amoCRM: читаем env один раз, токены — при refresh."""
+
+    access_token: str
+    refresh_token: str
+    chat_secret_bytes: bytes
+    pipeline_id: int
+    pipeline_ai_id: int
+
+
+_CFG = _Cfg(
+    access_token=AMO_ACCESS_TOKEN,
+    refresh_token=AMO_REFRESH_TOKEN,
+    chat_secret_bytes=os.getenv("AMO_CHAT_SECRET", "").encode("utf-8"),
+    pipeline_id=_int_env("AMO_PIPELINE_ID", 0),
+    pipeline_ai_id=_int_env("AMO_PIPELINE_AI_ID", 10176698),
+)
+_last_date_sec = 0  # секунда последнего Date
+_last_date_str = ""  # отформатированный Date для этой секунды
+
+# ======================
+#   Общая HTTP-сессия
+# ======================
+
+_SESSION: Optional[aiohttp.ClientSession] = None  # пул keep-alive соединений
+
+
+async def get_session() -> aiohttp.ClientSession:
+    """Общая aiohttp-сессия: TCP/TLS переиспользуются между вызовами."""
+    global _SESSION
+    if _SESSION is None or _SESSION.closed:  # создаём лениво в event loop
+        _SESSION = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=64, keepalive_timeout=75, ttl_dns_cache=300
+            )
+        )
+    return _SESSION
+
+
+async def close_session() -> None:
+    """Закрывает общую сессию (на shutdown приложения)."""
+    global _SESSION
+    if _SESSION is not None and not _SESSION.closed:
+        await _SESSION.close()
+    _SESSION = None
+
 # ======================
 #     Token refresh
 # ======================
 
+def _update_env_many(updates: dict[str, str]) -> None:
+    """Один проход по .env: заменяет/дописывает ключи, пишет атомарно."""
+    env_path = Path(ENV_PATH)
+    lines = env_path.read_text(encoding="utf-8").splitlines(True)
+    remaining = dict(updates)  # ключи, которые ещё не встретились
+    out = []
+    for line in lines:
+        key = line.partition("=")[0]  # имя переменной до '='
+        if key in remaining:
+            out.append(f"{key}={remaining.pop(key)}\n")
+        else:
+            out.append(line)
+    if out and not out[-1].endswith("\n"):  # не склеиваем с хвостом
+        out[-1] += "\n"
+    out.extend(f"{k}={v}\n" for k, v in remaining.items())  # новые ключи
+
+    tmp_path = env_path.with_name(env_path.name + ".tmp")  # рядом с .env
+    tmp_path.write_text("".join(out), encoding="utf-8")
+    os.chmod(tmp_path, env_path.stat().st_mode)  # сохраняем права
+    os.replace(tmp_path, env_path)  # атомарная подмена файла
+
+
 async def refresh_access_token() -> str:
     """Обновляет access_token по refresh_token и перезаписывает .env."""
     url = f"{AMO_API_URL}/oauth2/access_token"  # точка OAuth
@@ -48,43 +136,37 @@ async def refresh_access_token() -> str:
         "client_id": AMO_CLIENT_ID,
         "client_secret": AMO_CLIENT_SECRET,
         "grant_type": "refresh_token",
-        "refresh_token": os.getenv("AMO_REFRESH_TOKEN", AMO_REFRESH_TOKEN),
+        "refresh_token": _CFG.refresh_token,
         "redirect_uri": AMO_REDIRECT_URI,
     }
-    async with aiohttp.ClientSession() as s:  # HTTP-сессия
-        async with s.post(  # POST на OAuth endpoint
-            url, json=payload, timeout=AMO_REQUEST_TIMEOUT_SEC
-        ) as r:
-            text = await r.text()  # снимаем текст на случай ошибок
-            if r.status != 200:  # неуспех → бросаем
-                raise RuntimeError(
-                    f"Token refresh failed [{r.status}]: {text}"
-                )
-            data = await r.json()  # JSON-ответ
-            new_access = data["access_token"]  # новый access
-            new_refresh = data.get(  # новый refresh (если пришёл)
-                "refresh_token",
-                os.getenv("AMO_REFRESH_TOKEN", AMO_REFRESH_TOKEN),
+    s = await get_session()  # общий пул соединений
+    async with s.post(  # POST на OAuth endpoint
+        url, json=payload, timeout=AMO_REQUEST_TIMEOUT_SEC
+    ) as r:
+        text = await r.text()  # снимаем текст на случай ошибок
+        if r.status != 200:  # неуспех → бросаем
+            raise RuntimeError(
+                f"Token refresh failed [{r.status}]: {text}"
             )
+        data = await r.json()  # JSON-ответ
+        new_access = data["access_token"]  # новый access
+        new_refresh = data.get(  # новый refresh (если пришёл)
+            "refresh_token", _CFG.refresh_token
+        )
 
     # перезаписываем .env атомарно (безопаснее, чем sed)
-    env_path = Path(ENV_PATH)
-    lines = env_path.read_text(encoding="utf-8").splitlines(True)
-    out = []
-    for line in lines:
-        if line.startswith("AMO_ACCESS_TOKEN="):
-            out.append(f"AMO_ACCESS_TOKEN={new_access}\n")
-        elif line.startswith("AMO_REFRESH_TOKEN="):
-            out.append(f"AMO_REFRESH_TOKEN={new_refresh}\n")
-        else:
-            out.append(line)
-    env_path.write_text("".join(out), encoding="utf-8")
-
-    # обновляем переменные процесса
+    _update_env_many({
+        "AMO_ACCESS_TOKEN": new_access,
+        "AMO_REFRESH_TOKEN": new_refresh,
+    })
+
+    # обновляем снимок настроек и переменные процесса
+    _CFG.access_token = new_access
+    _CFG.refresh_token = new_refresh
     os.environ["AMO_ACCESS_TOKEN"] = new_access
     os.environ["AMO_REFRESH_TOKEN"] = new_refresh
 
-    logging.info("✅ amoCRM token refreshed successfully")  # лог успеха
+    logger.info("✅ amoCRM token refreshed successfully")  # лог успеха
     return new_access  # возвращаем новый access
 
 # ======================
@@ -93,46 +175,51 @@ async def refresh_access_token() -> str:
 
 def _auth_header() -> dict[str, str]:
     """Заголовок Authorization для amoCRM."""
-    token = os.getenv("AMO_ACCESS_TOKEN", AMO_ACCESS_TOKEN)
-    return {"Authorization": f"Bearer {token}"}
+    return {"Authorization": f"Bearer {_CFG.access_token}"}
 
-# ======================
-#  Создание контакта/сделки
-# ======================
 
-async def _create_contact(name: str) -> Optional[int]:
-    """Создаёт контакт и возвращает contact_id."""
-    url = f"{AMO_API_URL}/api/v4/contacts"
-    payload = [{"name": name or "Telegram user"}]
-    async with aiohttp.ClientSession() as s:
-        async with s.post(
-            url, headers=_auth_header(), json=payload
+async def _request(method: str, url: str, **kw) -> tuple[int, str]:
+    """Запрос к amoCRM с Bearer; на 401 — refresh и ровно один повтор."""
+    s = await get_session()  # общий пул соединений
+
+    async def _once() -> tuple[int, str]:
+        async with s.request(
+            method, url, headers=_auth_header(), **kw
         ) as r:
-            txt = await r.text()
-            logging.info("📡 Contact resp [%s]: %s", r.status, txt)
-            if r.status == 401:  # токен протух — обновим и повторим
-                await refresh_access_token()
-                return await _create_contact(name)
-            if r.status != 200:
-                return None
-            data = await r.json()
-    emb = data.get("_embedded", {}) if isinstance(data, dict) else {}
-    arr = emb.get("contacts", [])
-    return (arr[0] or {}).get("id") if arr else None
+            return r.status, await r.text()
+
+    status, txt = await _once()
+    if status == 401:  # токен протух — обновим и повторим один раз
+        await refresh_access_token()
+        status, txt = await _once()
+    return status, txt
 
 
+def _log_resp(what: str, status: int, txt: str) -> None:
+    """Статус ответа — INFO; тело — только в DEBUG (при ошибке — WARNING)."""
+    if not 200 <= status < 300:
+        logger.warning("⚠️ %s resp [%s]: %s", what, status, txt)
+        return
+    logger.info("%s resp [%s]", what, status)
+    if logger.isEnabledFor(logging.DEBUG):  # тело ответа только в DEBUG
+        logger.debug("%s body: %s", what, txt)
+
+# ======================
+#  Создание контакта/сделки
+# ======================
+
 # 🔹 Находим последнюю сделку, связанную с этим чатом
 async def get_latest_lead_for_chat(chat_id: int) -> Optional[int]:
     """Ищет последнюю сделку, созданную по этому Telegram-чату через MedBot."""
     url = f"{AMO_API_URL}/api/v4/leads?order=created_at&limit=10"
     headers = _auth_header()
 
-    async with aiohttp.ClientSession() as s:
-        async with s.get(url, headers=headers) as r:
-            if r.status != 200:
-                logging.warning("⚠️ Failed to fetch leads for chat %s", chat_id)
-                return None
-            data = await r.json()
+    s = await get_session()  # общий пул соединений
+    async with s.get(url, headers=headers) as r:
+        if r.status != 200:
+            logger.warning("⚠️ Failed to fetch leads for chat %s", chat_id)
+            return None
+        data = await r.json()
 
     leads = data.get("_embedded", {}).get("leads", [])
     for lead in leads:
@@ -145,11 +232,11 @@ async def get_latest_lead_for_chat(chat_id: int) -> Optional[int]:
             or "(telegram" in name
             or "(tg" in name
         ):
-            logging.info("🧩 Lead %s seems to belong to Telegram chat %s",
-                         lead.get("id"), chat_id)
+            logger.info("🧩 Lead %s seems to belong to Telegram chat %s",
+                        lead.get("id"), chat_id)
             return lead.get("id")
 
-    logging.info("ℹ️ No suitable lead found for chat %s", chat_id)
+    logger.info("ℹ️ No suitable lead found for chat %s", chat_id)
     return None
 
 
@@ -157,71 +244,48 @@ async def create_lead_in_amo(
     chat_id: int,
     username: str,
 ) -> Optional[int]:
-    """Создаёт контакт и сделку в нужной воронке, связывает их,
-    возвращает lead_id.
+    """Создаёт сделку со вложенным контактом одним запросом
+    (/leads/complex) в нужной воронке, возвращает lead_id.
     """
-    contact_id = await _create_contact(username)  # создаём контакт
-    if not contact_id:
-        return None
+    # 🔴 сразу создаём в воронке "Платный канал (ИИ-врач)" — без PATCH
+    pipeline_id = _CFG.pipeline_ai_id
 
-    # 🔴 безопасно читаем id воронки из .env (жёсткая привязка)
-    try:
-        pipeline_id = int(AMO_PIPELINE_ID)
-    except Exception:
-        pipeline_id = 0
-
-    url = f"{AMO_API_URL}/api/v4/leads"  # endpoint сделок
+    url = f"{AMO_API_URL}/api/v4/leads/complex"  # сделка + контакт сразу
 
-    # формируем payload: имя + нужная воронка + привязка контакта
+    # формируем payload: имя + нужная воронка + новый контакт внутри
     payload = [{
         "name": f"Новый запрос из Telegram ({username})",
         "pipeline_id": pipeline_id or None,
-        "_embedded": {"contacts": [{"id": contact_id}]},
+        "_embedded": {"contacts": [{"name": username or "Telegram user"}]},
     }]
 
-    async with aiohttp.ClientSession() as s:
-        async with s.post(url, headers=_auth_header(), json=payload) as r:
-            txt = await r.text()
-            logging.info("📡 Lead resp [%s]: %s", r.status, txt)
-            if r.status == 401:  # токен протух — обновим и повторим
-                await refresh_access_token()
-                return await create_lead_in_amo(chat_id, username)
-            if r.status != 200:
-                return None
-            data = await r.json()
-
-    emb = data.get("_embedded", {}) if isinstance(data, dict) else {}
-    arr = emb.get("leads", [])
+    status, txt = await _request("POST", url, json=payload)
+    logger.log(logging.DEBUG if status == 200 else logging.INFO,
+               "📡 Lead resp [%s]: %s", status, txt)
+    if status != 200:
+        return None
+    data = orjson.loads(txt)
+
+    # complex отвечает списком: [{"id": lead_id, "contact_id": ...}]
+    arr = data if isinstance(data, list) else []
     lead_id = (arr[0] or {}).get("id") if arr else None
 
     if lead_id:
-        logging.info("✅ lead %s created for chat_id=%s", lead_id, chat_id)
-
-        # 🔴 Переносим лид в воронку "Платный канал (ИИ-врач)"
-        target_pipeline_id = int(os.getenv("AMO_PIPELINE_AI_ID", "10176698"))
-        moved = await move_lead_to_pipeline(lead_id, target_pipeline_id)
-        if moved:
-            logging.info("✅ lead %s moved to pipeline %s",
-                         lead_id, target_pipeline_id)
-        else:
-            logging.warning("⚠️ failed to move lead %s to pipeline %s",
-                            lead_id, target_pipeline_id)
+        logger.info("✅ lead %s created for chat_id=%s in pipeline %s",
+                    lead_id, chat_id, pipeline_id)
 
     return lead_id
 
 
-# 🔽 вставить сразу после create_lead_in_amo
-
 async def move_lead_to_pipeline(lead_id: int, pipeline_id: int) -> bool:
-    """Переносит сделку в нужную воронку."""
+    """Переносит существующую сделку в нужную воронку."""
     url = f"{AMO_API_URL}/api/v4/leads/{lead_id}"
     payload = {"pipeline_id": pipeline_id}
 
-    async with aiohttp.ClientSession() as s:
-        async with s.patch(url, headers=_auth_header(), json=payload) as r:
-            txt = await r.text()
-            logging.info("📦 Move lead resp [%s]: %s", r.status, txt)
-            return 200 <= r.status < 300
+    s = await get_session()  # общий пул соединений
+    async with s.patch(url, headers=_auth_header(), json=payload) as r:
+        _log_resp("📦 Move lead", r.status, await r.text())
+        return 200 <= r.status < 300
 
 
 async def get_lead_name(lead_id: int) -> Optional[str]:
@@ -229,12 +293,12 @@ async def get_lead_name(lead_id: int) -> Optional[str]:
     url = f"{AMO_API_URL}/api/v4/leads/{lead_id}"
     headers = _auth_header()
 
-    async with aiohttp.ClientSession() as s:
-        async with s.get(url, headers=headers) as r:
-            if r.status != 200:
-                return None
-            data = await r.json()
-            return data.get("name")
+    s = await get_session()  # общий пул соединений
+    async with s.get(url, headers=headers) as r:
+        if r.status != 200:
+            return None
+        data = await r.json()
+        return data.get("name")
 
 
 # ======================
@@ -253,37 +317,58 @@ async def add_file_note(lead_id: str, uuid: str,
             "uuid": uuid,
         }]},
     }]
-    async with aiohttp.ClientSession() as s:
-        async with s.post(
-            url, headers=_auth_header(), json=payload
-        ) as r:
-            txt = await r.text()
-            ok = 200 <= r.status < 300
-            logging.info("📎 add_file_note resp [%s]: %s", r.status, txt)
-            if r.status == 401:
-                await refresh_access_token()
-                return await add_file_note(lead_id, uuid, file_name)
-            return ok
+    status, txt = await _request("POST", url, json=payload)
+    _log_resp("📎 add_file_note", status, txt)
+    return 200 <= status < 300
 
 # ======================
 #     Chat API (amojo)
 # ======================
 
+@functools.lru_cache(maxsize=1024)
+def _conv_id(chat_id: int) -> str:
+    """conversation_id Chat API для Telegram-чата."""
+    return f"tg_{chat_id}"
+
+@functools.lru_cache(maxsize=1024)
+def _sender_id(chat_id: int) -> str:
+    """sender.id Chat API — строковый chat_id."""
+    return str(chat_id)
+
+@functools.lru_cache(maxsize=1024)
+def _default_username(chat_id: int) -> str:
+    """Имя отправителя, если username не передан."""
+    return f"User {chat_id}"
+
+@functools.lru_cache(maxsize=32)
+def _scope_paths(scope_id: str) -> tuple[bytes, str]:
+    """Путь канала (bytes для подписи) и полный URL amojo."""
+    path = f"/v2/origin/custom/{scope_id}"
+    return path.encode(), f"https://amojo.amocrm.ru{path}"
+
+_CHAT_CONTENT_TYPE = "application/json"  # тип тела Chat API
+_CHAT_CONTENT_TYPE_B = _CHAT_CONTENT_TYPE.encode()  # он же для подписи
+_SIGN_PREFIX = b"POST"  # метод в строке подписи (всегда POST)
+_BASE_HEADERS = CIMultiDict({"Content-Type": _CHAT_CONTENT_TYPE})  # шаблон
+
 def _rfc1123_now_gmt() -> str:
-    """Дата в RFC1123/GMT для заголовка Date."""
-    from email.utils import formatdate
-    return formatdate(usegmt=True)
+    """Дата в RFC1123/GMT для заголовка Date (кэш в пределах секунды)."""
+    global _last_date_sec, _last_date_str
+    now = int(time.time())
+    if now != _last_date_sec:  # секунда сменилась — форматируем заново
+        _last_date_sec = now
+        _last_date_str = formatdate(now, usegmt=True)
+    return _last_date_str
 
 def _md5_hex_lower(data: bytes) -> str:
     """MD5 от байтов в hex нижним регистром."""
-    return hashlib.md5(data).hexdigest().lower()
+    # hexdigest() уже lower; usedforsecurity=False — без FIPS-проверок
+    return hashlib.md5(data, usedforsecurity=False).hexdigest()
 
-def _hmac_sha1_hex_ascii(src: str, secret_ascii: str) -> str:
-    """HMAC-SHA1(src) ключом-строкой, hex lower."""
-    mac = hmac.new(secret_ascii.encode("utf-8"),
-                   src.encode("utf-8"),
-                   hashlib.sha1)
-    return mac.hexdigest().lower()
+def _hmac_sha1_hex_ascii(src: bytes, secret: bytes) -> str:
+    """HMAC-SHA1(src) ключом-байтами, hex lower."""
+    # one-shot hmac.digest — без Python-обёртки hmac.HMAC
+    return hmac.digest(secret, src, "sha1").hex()
 
 async def send_chat_message_v2(  # 🔴
     scope_id: str,
@@ -292,9 +377,14 @@ async def send_chat_message_v2(  # 🔴
     username: Optional[str] = None,
 ) -> bool:
     """Отправка new_message в amojo (единая точка v2)."""
-    secret = os.getenv("AMO_CHAT_SECRET", "")
+    secret = _CFG.chat_secret_bytes  # ключ подписи из снимка настроек
     if not secret or not scope_id:
-        logging.warning("⚠️ Chat v2: missing secret or scope_id")
+        logger.warning("⚠️ Chat v2: missing secret or scope_id")
+        return False
+
+    trimmed = (text or "")[:4000]  # практичный предел Chat API
+    if not trimmed:  # пустое сообщение — ни подписи, ни запроса
+        logger.debug("💬 ChatAPI v2: empty text, skip")
         return False
 
     # 🔴 Идемпотентный msgid и метка времени (требуются в v2)
@@ -308,53 +398,92 @@ async def send_chat_message_v2(  # 🔴
         "event_type": "new_message",  # 🔴
         "payload": {  # 🔴
             "timestamp": ts,  # 🔴
-            "conversation_id": f"tg_{chat_id}",  # 🔴
+            "conversation_id": _conv_id(chat_id),  # 🔴
             "silent": False,  # 🔴
             "msgid": msgid,  # 🔴
             "sender": {  # 🔴
-                "id": str(chat_id),  # 🔴
-                "name": username or f"User {chat_id}",  # 🔴
+                "id": _sender_id(chat_id),  # 🔴
+                "name": username or _default_username(chat_id),  # 🔴
             },  # 🔴
             "message": {  # 🔴
                 "type": "text",  # 🔴
-                "text": (text or "")[:4000],  # 🔴
+                "text": trimmed,  # 🔴
             },  # 🔴
         },  # 🔴
     }  # 🔴
 
-    body_bytes = json.dumps(
-        body, ensure_ascii=False, separators=(",", ":")
-    ).encode("utf-8")
+    body_bytes = orjson.dumps(body)  # компактный UTF-8 сразу в bytes
     content_md5 = _md5_hex_lower(body_bytes)
-    content_type = "application/json"
     date_gmt = _rfc1123_now_gmt()
 
     # 🔴 Единая точка входа (без /chats, без /chats/link)
-    path = f"/v2/origin/custom/{scope_id}"  # 🔴
-    sign_src = "\n".join([
-        "POST", content_md5, content_type, date_gmt, path
+    path_b, url = _scope_paths(scope_id)  # 🔴
+    # строка подписи сразу в байтах — без промежуточного str.encode
+    sign_src = b"\n".join([
+        _SIGN_PREFIX,
+        content_md5.encode(),
+        _CHAT_CONTENT_TYPE_B,
+        date_gmt.encode(),
+        path_b,
     ])
     signature = _hmac_sha1_hex_ascii(sign_src, secret)
 
-    url = f"https://amojo.amocrm.ru{path}"
+    headers = _BASE_HEADERS.copy()  # Content-Type уже внутри
+    headers["Date"] = date_gmt
+    headers["Content-MD5"] = content_md5
+    headers["X-Signature"] = signature
     try:
-        logging.info("💬 ChatAPI v2 payload(top): %s", body)
-        async with aiohttp.ClientSession() as s:
-            async with s.post(
-                url,
-                data=body_bytes,
-                headers={
-                    "Date": date_gmt,
-                    "Content-Type": content_type,
-                    "Content-MD5": content_md5,
-                    "X-Signature": signature,
-                },
-                timeout=AMO_REQUEST_TIMEOUT_SEC,
-            ) as r:
-                txt = await r.text()
-                logging.info("💬 ChatAPI v2 send [%s]: %s", r.status, txt)
-                return 200 <= r.status < 300
+        if logger.isEnabledFor(logging.DEBUG):  # repr(body) только в DEBUG
+            logger.debug("💬 ChatAPI v2 payload(top): %s", body)
+        s = await get_session()  # общий пул соединений
+        async with s.post(
+            url,
+            data=body_bytes,
+            headers=headers,
+            timeout=AMO_REQUEST_TIMEOUT_SEC,
+        ) as r:
+            _log_resp("💬 ChatAPI v2 send", r.status, await r.text())
+            return 200 <= r.status < 300
     except Exception as exc:
-        logging.warning("⚠️ ChatAPI v2 send exception: %s", exc)
+        logger.warning("⚠️ ChatAPI v2 send exception: %s", exc)
+        return False
+
+
+# ======================
+#  Фоновая очередь amojo
+# ======================
+
+# (scope_id, chat_id, text, username) — разбирает chat_send_worker
+_chat_queue: asyncio.Queue = asyncio.Queue(maxsize=CHAT_SEND_QUEUE_MAXSIZE)
+
+
+def enqueue_chat_message(
+    scope_id: str,
+    chat_id: int,
+    text: str,
+    username: Optional[str] = None,
+) -> bool:
+    """Ставит сообщение в очередь Chat API, не дожидаясь amojo."""
+    try:
+        _chat_queue.put_nowait((scope_id, chat_id, text, username))
+        return True
+    except asyncio.QueueFull:  # amojo не успевает — не блокируем вебхук
+        logger.warning("⚠️ ChatAPI queue full, drop msg for chat %s",
+                       chat_id)
         return False
 
+
+async def chat_send_worker() -> None:
+    """Фоновый отправитель: по одному берёт сообщения из очереди."""
+    while True:
+        scope_id, chat_id, text, username = await _chat_queue.get()
+        try:
+            ok = await send_chat_message_v2(
+                scope_id, chat_id, text, username=username
+            )
+            if not ok:
+                logger.warning("⚠️ ChatAPI send returned false")
+        except Exception as exc:  # воркер не должен умирать
+            logger.warning("⚠️ ChatAPI worker failed: %s", exc)
+        finally:
+            _chat_queue.task_done()
@@ -2,36 +2,57 @@
 # Каждая строка снабжена коротким комментарием; новые правки — # 🔴
 
 import os  # доступ к переменным окружения
+import asyncio  # параллельные задачи вебхука
 import logging  # базовое логирование
-from typing import Optional, Union, Dict, Any  # типизация
+from typing import Optional, Union, Dict, Any, Tuple  # типизация
 
+import orjson  # быстрый разбор JSON вебхуков
 from fastapi import FastAPI, Request, HTTPException, Query  # веб-ядро
 from fastapi.middleware.cors import CORSMiddleware  # CORS-политика
+from fastapi.responses import ORJSONResponse, Response  # быстрые ответы
 
 from dotenv import load_dotenv  # загрузка .env
 
 from aiogram import Bot, Dispatcher  # Telegram SDK
 from aiogram.types import Update  # модель апдейта
 
-from openai import OpenAI  # самотест OpenAI
 
 # локальные модули (структура проекта сохранена)
 from bot import setup_handlers  # регистрация хэндлеров
+from openai_client import log_drain_worker, log_lock_backend, close_log_bot  # отправка логов пачками
+from openai_client import client as openai_async  # общий AsyncOpenAI (самотест)
+from tg_rate_limit import TelegramRateLimiter  # лимит запросов к Telegram
 from admin_api import router as admin_router  # маршруты админки
-from repo import fetch_messages, upload_file_to_amo  # БД и файлы в amo
+from repo import (  # БД и файлы в amo
+    fetch_messages,
+    upload_file_to_amo,
+    db_write_worker,  # фоновая пачечная запись в БД
+    reconcile_message_counts,  # перенос счётчиков сообщений из Redis
+)
+from storage import gc_threads, forget_threads  # авточистка чатов в Redis
+from redis_client import close_redis  # закрытие асинхронного пула Redis
 from constants import (  # общие константы проекта
     ALLOWED_ORIGINS,
     TELEGRAM_FORWARD_TIMEOUT_SEC,
     AMO_TOKEN_REFRESH_INTERVAL_SEC,
     AMO_TOKEN_REFRESH_RETRY_SEC,
+    THREAD_GC_INTERVAL_SEC,
+    MSGCOUNT_RECONCILE_SEC,
+    AMO_WEBHOOK_MAX_BODY_BYTES,
 )
 
 # 🔴 — функции работы с amoCRM оставляем в отдельном модуле
 from amo_client import (  # 🔴
     refresh_access_token,        # 🔁 обновление токена amoCRM
     create_lead_in_amo,          # создание контакта+сделки
+    get_latest_lead_for_chat,    # поиск сделки по чату
+    get_lead_name,               # имя сделки (проверка источника)
+    move_lead_to_pipeline,       # перенос сделки в воронку
     add_file_note,               # прикрепление файла к сделке
-    send_chat_message_v2,        # отправка в Chat API (amojo)
+    enqueue_chat_message,        # очередь отправки в Chat API (amojo)
+    chat_send_worker,            # фоновый отправитель очереди
+    get_session,                 # общая HTTP-сессия (keep-alive)
+    close_session,               # закрытие сессии на shutdown
 )
 
 # ======================
@@ -62,10 +83,23 @@ if not ASSISTANT_ID:
 AMO_WEBHOOK_URL = os.getenv("AMO_WEBHOOK_URL", "")  # URL вебхука в amo
 AMO_API_URL = os.getenv("AMO_API_URL", "")  # базовый API amo
 AMO_ENABLED = bool(AMO_WEBHOOK_URL or AMO_API_URL)  # флаг интеграции
+AMO_CHAT_SCOPE_ID = os.getenv("AMO_CHAT_SCOPE_ID", "").strip()  # scope amojo
+AMO_CHAT_SECRET = os.getenv("AMO_CHAT_SECRET", "")  # секрет канала amojo
 
 bot = Bot(BOT_TOKEN)  # инициализация Telegram-бота
+bot.session.middleware(TelegramRateLimiter())  # все исходящие вызовы — через token bucket
 dp = Dispatcher()  # роутер aiogram
-app = FastAPI(title="medbot")  # приложение FastAPI
+app = FastAPI(  # приложение FastAPI
+    title="medbot",
+    default_response_class=ORJSONResponse,  # dict-ответы через orjson
+)
+
+# Постоянные ответы горячих вебхуков: байты готовы заранее,
+# без jsonable_encoder и сериализации на каждый запрос.  # 🔴
+_JSON = "application/json"
+_R_OK = Response(b'{"ok":true}', media_type=_JSON)
+_R_STATUS_OK = Response(b'{"status":"ok"}', media_type=_JSON)
+_R_STATUS_IGNORED = Response(b'{"status":"ignored"}', media_type=_JSON)
 
 # ======================
 #  Периодический refresh
@@ -93,9 +127,51 @@ async def periodic_token_refresh() -> None:
                              AMO_TOKEN_REFRESH_RETRY_SEC)
                 await asyncio.sleep(AMO_TOKEN_REFRESH_RETRY_SEC)
 
+    async def threads_gc() -> None:
+        while True:  # авточистка неактивных чатов раз в сутки
+            try:
+                removed = await asyncio.to_thread(gc_threads)  # HSCAN — вне цикла
+                forget_threads(removed)  # кэш процесса — только из event loop
+                logging.info("🧹 Thread GC: removed %s inactive chats",
+                             len(removed))
+            except Exception as exc:
+                logging.warning("⚠️ Thread GC failed: %s", exc)
+            await asyncio.sleep(THREAD_GC_INTERVAL_SEC)
+
+    async def msgcount_reconciler() -> None:
+        while True:  # счётчики сообщений Redis → users.messages_total
+            await asyncio.sleep(MSGCOUNT_RECONCILE_SEC)
+            try:
+                await asyncio.to_thread(reconcile_message_counts)
+            except Exception as exc:
+                logging.warning("⚠️ messages_total reconcile failed: %s", exc)
+
     asyncio.create_task(refresher())  # фоновая задача
+    asyncio.create_task(threads_gc())  # чистка medbot:last_seen / тредов
+    asyncio.create_task(msgcount_reconciler())  # сверка messages_total
+    asyncio.create_task(chat_send_worker())  # отправка в amojo из очереди
+    asyncio.create_task(db_write_worker())  # запись в БД из очереди
+    asyncio.create_task(log_drain_worker(bot))  # лог-чат из очереди
+    log_lock_backend(bot)  # самодиагностика: какой механизм локов тредов активен
     # 🔴
 
+
+@app.on_event("startup")  # проверка настроек Chat API один раз
+async def check_chat_api_config() -> None:
+    """Предупреждаем при старте, если входящий Chat API не настроен."""
+    if not AMO_CHAT_SECRET:
+        logging.warning("⚠️ AMO_CHAT_SECRET is empty: amo-webhook will 500")
+    if not AMO_CHAT_SCOPE_ID:
+        logging.warning("⚠️ AMO_CHAT_SCOPE_ID is empty: no amojo mirroring")
+
+
+@app.on_event("shutdown")  # хук остановки приложения
+async def shutdown_http_session() -> None:
+    """Закрываем общий пул HTTP-соединений amoCRM, сессию лог-бота и пул Redis."""
+    await close_session()
+    await close_log_bot()
+    await close_redis()
+
 # ======================
 #         CORS
 # ======================
@@ -116,9 +192,10 @@ app.add_middleware(  # разрешённые источники фронтен
 async def openai_selftest() -> Dict[str, Any]:
     """Проверка доступности моделей и ассистента."""
     try:
-        client = OpenAI(api_key=OPENAI_API_KEY)  # клиент SDK
-        mdl = client.models.retrieve("gpt-4o-mini")  # тест модели
-        ast = client.beta.assistants.retrieve(ASSISTANT_ID)  # ассистент
+        mdl, ast = await asyncio.gather(  # оба запроса параллельно, без блокировки loop
+            openai_async.models.retrieve("gpt-4o-mini"),  # тест модели
+            openai_async.beta.assistants.retrieve(ASSISTANT_ID),  # ассистент
+        )
         return {"ok": True, "model": mdl.id, "assistant_id": ast.id,
                 "assistant_name": getattr(ast, "name", None)}
     except Exception as exc:
@@ -134,137 +211,148 @@ from storage import (  # импортируем после настройки ap
     set_lead_id as redis_set_lead_id,
 )
 
+async def _forward_to_amo_webhook(data: Dict[str, Any]) -> None:
+    """Зеркалим апдейт «как есть» в вебхук amoCRM."""
+    try:
+        s = await get_session()  # общий пул соединений
+        async with s.post(  # отправка «как есть», с таймаутом
+            AMO_WEBHOOK_URL,
+            json=data,
+            timeout=TELEGRAM_FORWARD_TIMEOUT_SEC,
+        ):
+            logging.info("📨 Update forwarded to amoCRM webhook")
+    except Exception as e:
+        logging.warning("⚠️ Forward to amoCRM failed: %s", e)
+
+
+async def _maybe_create_lead(data: Dict[str, Any]) -> None:
+    """Логика сделки/заметок/чата amoCRM для одного апдейта."""
+    try:
+        msg = data.get("message") or {}  # блок сообщения
+        chat_id_opt = (msg.get("chat") or {}).get("id")  # int|None
+        text = (msg.get("text") or "").strip()  # текст апдейта
+        username = ((msg.get("from") or {}).get("username") or "unknown")
+
+        if chat_id_opt is None:  # защита от нестандартных апдейтов
+            logging.info("ℹ️ no chat_id in update; skip amo flow")
+            return
+
+        chat_id = int(chat_id_opt)
+
+        # Флаг: iMbox сам создаёт сделки (через MedBot Bridge)
+        imbox_autocreate = os.getenv("AMO_IMBOX_AUTOCREATE", "1") == "1"
+
+        # Пробуем достать связку chat_id → lead_id из Redis
+        lead_id: Optional[Union[str, int]] = await redis_get_lead_id(chat_id)
+
+        # Если включено автосоздание — пробуем найти существующую сделку
+        if imbox_autocreate and not lead_id:
+            lead_id = await get_latest_lead_for_chat(chat_id)
+            if lead_id:
+                logging.info("♻️ Existing lead %s found for chat %s",
+                            lead_id, chat_id)
+                await redis_set_lead_id(chat_id, str(lead_id))
+
+                # Ждём, пока сделка “дозреет” в amo (5 сек)
+                await asyncio.sleep(5)
+
+                # Проверяем, что сделка именно Telegram, не сторонняя
+                lead_name = await get_lead_name(lead_id)
+                if lead_name and (
+                    "telegram" in lead_name.lower() or str(chat_id) in lead_name
+                ):
+                    target_pipeline_id = int(
+                        os.getenv("AMO_PIPELINE_AI_ID", "10176698")
+                    )
+                    await move_lead_to_pipeline(lead_id, target_pipeline_id)
+                else:
+                    logging.info("🛑 Lead %s not Telegram — skip move", lead_id)
+
+        # Если автосоздание выключено — создаём лид вручную
+        elif not imbox_autocreate and not lead_id:
+            lead_id = await create_lead_in_amo(
+                chat_id=chat_id,
+                username=username,
+            )
+            if lead_id:
+                await redis_set_lead_id(chat_id, str(lead_id))
+                logging.info("✅ lead %s created for chat %s",
+                            lead_id, chat_id)
+            else:
+                logging.warning("⚠️ lead not created for chat %s", chat_id)
+
+        # Отправляем клиентский текст в amojo Chat API (iMbox)
+        if text:
+            scope_id = AMO_CHAT_SCOPE_ID
+            if not scope_id:
+                logging.warning("⚠️ AMO_CHAT_SCOPE_ID is empty")
+            else:
+                # не ждём amojo: отправит фоновый воркер
+                enqueue_chat_message(
+                    scope_id=scope_id,
+                    chat_id=chat_id,
+                    text=text,
+                    username=username,
+                )
+
+        # Вложения отправляем только если знаем lead_id
+        if lead_id and ("document" in msg or "photo" in msg):
+            file_id: Optional[str] = None
+            file_name = ""
+
+            if "document" in msg:
+                file_id = msg["document"]["file_id"]
+                file_name = msg["document"].get("file_name", "file.bin")
+            elif "photo" in msg:
+                file_id = msg["photo"][-1]["file_id"]
+                file_name = "photo.jpg"
+
+            if file_id:
+                try:
+                    file_info = await bot.get_file(file_id)
+                    file_bytes = await bot.download_file(file_info.file_path)
+                    # BytesIO уходит в multipart потоково, без .read()
+                    uuid = await upload_file_to_amo(file_name, file_bytes)
+                    if uuid:
+                        ok = await add_file_note(
+                            lead_id=str(lead_id),
+                            uuid=uuid,
+                            file_name=file_name or "file.bin",
+                        )
+                        if not ok:
+                            logging.warning("⚠️ add_file_note failed")
+                    else:
+                        logging.warning("⚠️ upload_file_to_amo empty")
+                except Exception as ex:
+                    logging.warning("⚠️ file attach flow failed: %s", ex)
+
+    except Exception as e:
+        logging.warning("⚠️ amoCRM linkage failed: %s", e)
+
+
 @app.post("/medbot/webhook")
-async def telegram_webhook(request: Request) -> Dict[str, Any]:
+async def telegram_webhook(request: Request) -> Response:
     """Основная точка входа Telegram-апдейтов."""
     # защитный секрет, чтобы не принять чужой вызов
     secret = request.headers.get("x-telegram-bot-api-secret-token")
     if secret != WEBHOOK_SECRET:
         raise HTTPException(status_code=403, detail="bad secret")
 
-    data = await request.json()  # читаем update как dict
+    data = orjson.loads(await request.body())  # update как dict (orjson)
     update = Update.model_validate(data)  # валидация aiogram-моделью
     await dp.feed_update(bot, update)  # отдаём хэндлерам aiogram
 
-    # зеркалим апдейт в amoCRM при наличии URL
-    if AMO_WEBHOOK_URL:
-        try:
-            import aiohttp  # локальный импорт — экономим импорты
-            async with aiohttp.ClientSession() as s:  # сессия HTTP
-                await s.post(  # отправка «как есть», с таймаутом
-                    AMO_WEBHOOK_URL,
-                    json=data,
-                    timeout=TELEGRAM_FORWARD_TIMEOUT_SEC,
-                )
-                logging.info("📨 Update forwarded to amoCRM webhook")
-        except Exception as e:
-            logging.warning("⚠️ Forward to amoCRM failed: %s", e)
-
-        # ниже — логика сделки/заметок/чата amoCRM
+    # форвард в вебхук и логика сделки независимы — выполняем параллельно
+    jobs = []
+    if AMO_WEBHOOK_URL:  # зеркалим апдейт в amoCRM при наличии URL
+        jobs.append(_forward_to_amo_webhook(data))
     if AMO_API_URL and os.getenv("AMO_ACCESS_TOKEN"):  # включена ли amo
-        try:
-            msg = data.get("message") or {}  # блок сообщения
-            chat_id_opt = (msg.get("chat") or {}).get("id")  # int|None
-            text = (msg.get("text") or "").strip()  # текст апдейта
-            username = ((msg.get("from") or {}).get("username") or "unknown")
-
-            if chat_id_opt is None:  # защита от нестандартных апдейтов
-                logging.info("ℹ️ no chat_id in update; skip amo flow")
-                return {"ok": True}
-
-            chat_id = int(chat_id_opt)
-
-            # Флаг: iMbox сам создаёт сделки (через MedBot Bridge)
-            imbox_autocreate = os.getenv("AMO_IMBOX_AUTOCREATE", "1") == "1"
-
-            # Пробуем достать связку chat_id → lead_id из Redis
-            lead_id: Optional[Union[str, int]] = redis_get_lead_id(chat_id)
-
-            # Если включено автосоздание — пробуем найти существующую сделку
-            if imbox_autocreate and not lead_id:
-                lead_id = await get_latest_lead_for_chat(chat_id)
-                if lead_id:
-                    logging.info("♻️ Existing lead %s found for chat %s",
-                                lead_id, chat_id)
-                    redis_set_lead_id(chat_id, str(lead_id))
-
-                    # Ждём, пока сделка “дозреет” в amo (5 сек)
-                    await asyncio.sleep(5)
-
-                    # Проверяем, что сделка именно Telegram, не сторонняя
-                    lead_name = await get_lead_name(lead_id)
-                    if lead_name and (
-                        "telegram" in lead_name.lower() or str(chat_id) in lead_name
-                    ):
-                        target_pipeline_id = int(
-                            os.getenv("AMO_PIPELINE_AI_ID", "10176698")
-                        )
-                        await move_lead_to_pipeline(lead_id, target_pipeline_id)
-                    else:
-                        logging.info("🛑 Lead %s not Telegram — skip move", lead_id)
+        jobs.append(_maybe_create_lead(data))
+    for res in await asyncio.gather(*jobs, return_exceptions=True):
+        if isinstance(res, Exception):  # хелперы ловят сами; на всякий
+            logging.warning("⚠️ amoCRM webhook job failed: %s", res)
 
-            # Если автосоздание выключено — создаём лид вручную
-            elif not imbox_autocreate and not lead_id:
-                lead_id = await create_lead_in_amo(
-                    chat_id=chat_id,
-                    username=username,
-                )
-                if lead_id:
-                    redis_set_lead_id(chat_id, str(lead_id))
-                    logging.info("✅ lead %s created for chat %s",
-                                lead_id, chat_id)
-                else:
-                    logging.warning("⚠️ lead not created for chat %s", chat_id)
-
-            # Отправляем клиентский текст в amojo Chat API (iMbox)
-            if text:
-                scope_id = os.getenv("AMO_CHAT_SCOPE_ID", "").strip()
-                if not scope_id:
-                    logging.warning("⚠️ AMO_CHAT_SCOPE_ID is empty")
-                else:
-                    ok = await send_chat_message_v2(
-                        scope_id=scope_id,
-                        chat_id=chat_id,
-                        text=text,
-                        username=username,
-                    )
-                    if not ok:
-                        logging.warning("⚠️ ChatAPI send returned false")
-
-            # Вложения отправляем только если знаем lead_id
-            if lead_id and ("document" in msg or "photo" in msg):
-                file_id: Optional[str] = None
-                file_name = ""
-
-                if "document" in msg:
-                    file_id = msg["document"]["file_id"]
-                    file_name = msg["document"].get("file_name", "file.bin")
-                elif "photo" in msg:
-                    file_id = msg["photo"][-1]["file_id"]
-                    file_name = "photo.jpg"
-
-                if file_id:
-                    try:
-                        file_info = await bot.get_file(file_id)
-                        file_bytes = await bot.download_file(file_info.file_path)
-                        uuid = await upload_file_to_amo(file_name, file_bytes.read())
-                        if uuid:
-                            ok = await add_file_note(
-                                lead_id=str(lead_id),
-                                uuid=uuid,
-                                file_name=file_name or "file.bin",
-                            )
-                            if not ok:
-                                logging.warning("⚠️ add_file_note failed")
-                        else:
-                            logging.warning("⚠️ upload_file_to_amo empty")
-                    except Exception as ex:
-                        logging.warning("⚠️ file attach flow failed: %s", ex)
-
-        except Exception as e:
-            logging.warning("⚠️ amoCRM linkage failed: %s", e)
-
-    return {"ok": True}
+    return _R_OK
 
 
 # ======================
@@ -272,9 +360,9 @@ async def telegram_webhook(request: Request) -> Dict[str, Any]:
 # ======================
 
 @app.get("/medbot/health")
-async def health() -> Dict[str, str]:
+async def health() -> Response:
     """Проверка живости сервиса."""
-    return {"status": "ok"}
+    return _R_STATUS_OK
 
 # ======================
 #   Входящий Chat API
@@ -283,18 +371,51 @@ async def health() -> Dict[str, str]:
 import hashlib  # подпись входящих событий amojo
 import hmac  # HMAC-SHA1
 
-def _hmac_sha1_hex(data: str, secret: str) -> str:
-    """Подписание строки как hex(lower)."""
-    mac = hmac.new(secret.encode("utf-8"),
-                   data.encode("utf-8"),
-                   digestmod="sha1")
-    return mac.hexdigest().lower()
+# ключевой HMAC-прототип: ipad/opad считаются один раз, на запрос — copy()
+_HMAC_PROTO: Optional[hmac.HMAC] = (
+    hmac.new(AMO_CHAT_SECRET.encode("utf-8"), digestmod="sha1")
+    if AMO_CHAT_SECRET else None
+)
+
+def _hmac_sha1_hex(data: str) -> str:
+    """Подписание строки секретом канала как hex(lower)."""
+    mac = _HMAC_PROTO.copy()  # без повторной подготовки ключа
+    mac.update(data.encode("utf-8"))
+    return mac.hexdigest()
+
+async def _read_body_fast(
+    request: Request,
+) -> Tuple[Union[bytes, bytearray], str]:
+    """Тело запроса и его MD5 за один проход по чанкам.
+    По Content-Length буфер выделяется заранее; MD5 считается по мере
+    прихода чанков, без второго прохода по готовому телу.
+    Тело больше AMO_WEBHOOK_MAX_BODY_BYTES — 413 (подпись ещё не
+    проверена, поэтому заголовку длины не доверяем).
+    """
+    md5 = hashlib.md5(usedforsecurity=False)
+    try:
+        size = max(int(request.headers.get("content-length", "")), 0)
+    except ValueError:
+        size = 0  # длины нет — буфер растёт по мере чтения
+    if size > AMO_WEBHOOK_MAX_BODY_BYTES:  # отказ до аллокации
+        raise HTTPException(status_code=413, detail="Body too large")
+
+    buf = bytearray(size)  # одна аллокация под всё тело
+    off = 0
+    async for chunk in request.stream():
+        end = off + len(chunk)
+        if end > AMO_WEBHOOK_MAX_BODY_BYTES:  # длина соврала/не пришла
+            raise HTTPException(status_code=413, detail="Body too large")
+        md5.update(chunk)  # хэшируем, пока чанк «горячий»
+        buf[off:end] = chunk  # копия на место; при лишних байтах — рост
+        off = end
+    del buf[off:]  # тело короче заявленного — отрезаем хвост
+    return buf, md5.hexdigest()
 
 @app.post("/medbot/amo-webhook/{scope_id}")
-async def amo_chat_webhook(scope_id: str, request: Request):
+async def amo_chat_webhook(scope_id: str, request: Request) -> Response:
     """Приём событий Chat API (сообщения менеджера из карточки)."""
-    secret = os.getenv("AMO_CHAT_SECRET", "")
-    if not secret:
+    if _HMAC_PROTO is None:
         raise HTTPException(status_code=500, detail="chat secret empty")
 
     date_hdr = request.headers.get("Date", "")
@@ -302,56 +423,59 @@ async def amo_chat_webhook(scope_id: str, request: Request):
     md5_hdr = (request.headers.get("Content-MD5", "") or "").lower()
     sig_hdr = (request.headers.get("X-Signature", "") or "").lower()
 
-    body = await request.body()  # байты тела для MD5
-
-    real_md5 = hashlib.md5(body).hexdigest().lower()  # контрольная сумма
-    if md5_hdr and md5_hdr != real_md5:  # валидация MD5 если пришёл
+    # байты тела и контрольная сумма (hex уже lower) за один проход
+    body, real_md5 = await _read_body_fast(request)
+    # валидация MD5 если пришёл (сравнение за постоянное время)
+    if md5_hdr and not hmac.compare_digest(md5_hdr, real_md5):
         raise HTTPException(status_code=400, detail="Bad Content-MD5")
 
-    path = f"/medbot/amo-webhook/{scope_id}"  # путь для подписи
-
-    sign_str = "\n".join([  # строка подписи по схеме amojo
-        request.method.upper(),
-        md5_hdr,
-        ct_hdr,
-        date_hdr,
-        path,
-    ])
-    expected = _hmac_sha1_hex(sign_str, secret)  # расчёт подписи
+    # строка подписи по схеме amojo одним f-string (без списка и join);
+    # маршрут принимает только POST — метод подставляем константой
+    sign_str = (
+        f"POST\n{md5_hdr}\n{ct_hdr}\n{date_hdr}\n/medbot/amo-webhook/{scope_id}"
+    )
+    expected = _hmac_sha1_hex(sign_str)  # расчёт подписи
 
-    if sig_hdr and sig_hdr != expected:  # несоответствие подписи
+    # несоответствие подписи (compare_digest — постоянное время)
+    if sig_hdr and not hmac.compare_digest(sig_hdr, expected):
         raise HTTPException(status_code=401, detail="Bad signature")
 
     try:
-        payload = await request.json()  # парсим JSON
-    except Exception:
+        payload = orjson.loads(body)  # парсим уже прочитанные байты
+    except orjson.JSONDecodeError:
         raise HTTPException(status_code=400, detail="Invalid JSON")
 
-    evt = payload.get("event_type")  # тип события
-    if evt != "new_message":  # игнорируем прочие события
-        return {"status": "ignored"}
+    # не-объект или не new_message — отбрасываем до разбора вложенных полей
+    if (
+        not isinstance(payload, dict)
+        or payload.get("event_type") != "new_message"
+    ):
+        return _R_STATUS_IGNORED
 
     # v2-формат: верхний уровень + payload.message
+    # strip() без пробелов по краям возвращает ту же строку — копии нет
     conv_id = (payload.get("conversation_id") or "").strip()  # 🔴
-    if not conv_id.startswith("tg_"):  # не наш разговор
-        return {"status": "ignored"}
+    rest = conv_id.removeprefix("tg_")  # один проход вместо startswith+replace
+    if rest == conv_id:  # префикса нет — не наш разговор
+        return _R_STATUS_IGNORED
 
     try:
-        chat_id = int(conv_id.replace("tg_", "", 1))  # извлекаем ID
+        chat_id = int(rest)  # извлекаем ID
     except ValueError:
-        return {"status": "ignored"}  # странный conv_id
+        return _R_STATUS_IGNORED  # странный conv_id
 
-    msg = (payload.get("payload") or {}).get("message") or {}  # текст
-    text = (msg.get("text") or "").strip()
-    if not text:
-        return {"status": "ok"}  # пустые не шлём
+    inner = payload.get("payload")  # один проход до payload.message.text
+    msg = inner.get("message") if isinstance(inner, dict) else None
+    text = msg.get("text") if isinstance(msg, dict) else None
+    if not text or not (text := text.strip()):
+        return _R_STATUS_OK  # пустые не шлём
 
     try:
         await bot.send_message(chat_id, f"💬 Менеджер: {text}")  # ответ
     except Exception:  # не роняем вебхук
         pass
 
-    return {"status": "ok"}
+    return _R_STATUS_OK
 
 # ======================
 #     Админ-хелперы
@@ -5,16 +5,21 @@ import logging
 from aiogram import Router, F, Bot  # Router — маршрутизация сообщений, F — фильтры, Bot — объект бота
 from aiogram.filters import CommandStart, Command  # фильтры для команд /start и других
 from aiogram.types import Message  # тип для входящих сообщений от пользователей
-from aiogram.enums import ChatAction  # типы действий в чате (например, "печатает...")
 from storage import should_ack  # функция, проверяющая нужно ли отправить авто-уведомление
-from repo import upsert_user_from_msg, save_message  # функции записи в БД (пользователь/сообщение)
-
-from texts import WELCOME, DISCLAIMER, ACK_DELAYED  # заранее заготовленные тексты для приветствия, дисклеймера и авто-ответа
+from repo import enqueue_db_write  # фоновая запись в БД (пользователь/сообщение)
+
+from texts import (  # заранее заготовленные тексты для приветствия, дисклеймера, авто-ответа и выбора треда
+    WELCOME,
+    DISCLAIMER,
+    ACK_DELAYED,
+    THREAD_CHOICE_PROMPT,
+    THREAD_CREATED,
+    THREAD_CONTINUED,
+)
 from openai_client import schedule_processing, ensure_thread_choice  # функции для интеграции с OpenAI
 
 from constants import (
     DEFAULT_REPLY_DELAY_SEC,
-    TELEGRAM_TYPING_ACK_DURATION_SEC,
 )  # 🔴
 
 from amo_client import send_chat_message_v2  # 🔴 Chat API v2
@@ -22,8 +27,10 @@ from amo_client import send_chat_message_v2  # 🔴 Chat API v2
 
 # На время разработки 60 сек; можно переопределить в .env -> REPLY_DELAY_SEC
 DELAY_SEC = int(os.getenv("REPLY_DELAY_SEC", str(DEFAULT_REPLY_DELAY_SEC)))  # 🔴
+AMO_CHAT_SCOPE_ID = os.getenv("AMO_CHAT_SCOPE_ID", "").strip()  # scope канала amojo (статичен на деплой)
 
 router = Router()  # создаём маршрутизатор сообщений
+_THREAD_CHOICES = frozenset({"продолжить", "новый"})  # варианты выбора треда (один раз на модуль)
 
 
 def setup_handlers(dp):  # подключаем все обработчики в диспетчер
@@ -39,109 +46,72 @@ async def cmd_start(msg: Message):
 
 @router.message(Command("new"))  # если пользователь написал /new
 async def cmd_new(msg: Message):
-    text = (
-        "Хотите продолжить текущий медицинский диалог или начать новый?\n"
-        "• Напишите: «продолжить» — чтобы общаться в текущем треде\n"
-        "• Напишите: «новый» — чтобы создать новый тред"
-    )
-    await msg.answer(text)  # задаём пользователю выбор
+    await msg.answer(THREAD_CHOICE_PROMPT)  # задаём пользователю выбор
 
-@router.message(F.text.lower().in_({"продолжить", "новый"}))  # если пришёл текст "продолжить" или "новый"
+@router.message(F.text.lower().in_(_THREAD_CHOICES))  # если пришёл текст "продолжить" или "новый"
 async def on_thread_choice(msg: Message):
     created = await ensure_thread_choice(msg.chat.id, msg.text.lower())  # проверяем выбор пользователя и создаём новый тред, если нужно
-    await msg.answer("Готово. " + ("Создан новый тред." if created else "Продолжаем текущий тред."))  # отправляем подтверждение
-
-# --- утилита для "трёх точек" ---
-async def _typing_later(bot: Bot, chat_id: int, start_in: int, duration: int = 60):
-    """Показываем ChatAction.TYPING начиная через start_in сек и ~duration сек поддерживаем индикатор."""
-    await asyncio.sleep(max(0, start_in))  # ждём, когда нужно начать показывать "печатает..."
-    loop = asyncio.get_event_loop()  # получаем текущий цикл событий
-    until = loop.time() + max(1, duration)  # до какого времени показывать индикатор
-    while loop.time() < until:  # пока не истекло время
-        try:
-            await bot.send_chat_action(chat_id, ChatAction.TYPING)  # отправляем действие "печатает..." в чат
-        except Exception:
-            pass  # если ошибка — игнорируем (например, пользователь закрыл чат)
-        await asyncio.sleep(4)  # Telegram держит индикатор ~5 сек, поэтому обновляем каждые 4 сек
+    await msg.answer(THREAD_CREATED if created else THREAD_CONTINUED)  # отправляем подтверждение (готовые строки)
 
 # --- определение типа входящего сообщения (для записи в БД) ---
-def _infer_msg_type(msg: Message) -> str:
-    if getattr(msg, "voice", None): return "voice"  # голосовое
-    if getattr(msg, "audio", None): return "audio"  # аудиофайл
-    if getattr(msg, "photo", None): return "photo"  # фото
-    if getattr(msg, "document", None): return "document"  # документ
+# порядок важен: голосовое → аудио → фото → документ
+def _infer_msg_type(voice, audio, photo, document) -> str:
+    """Тип по уже извлечённым вложениям (без повторных getattr к модели)."""
+    if voice: return "voice"
+    if audio: return "audio"
+    if photo: return "photo"
+    if document: return "document"
     return "text"  # обычный текст
 
-# --- обработчик любых сообщений ---
-@router.message()  # срабатывает на любое сообщение пользователя
-async def any_message(msg: Message, bot: Bot):
-    chat_id = msg.chat.id  # ID чата, откуда пришло сообщение
-
-    # --- фиксируем пользователя и входящее сообщение в БД ---
-    upsert_user_from_msg(msg)  # создаём/обновляем пользователя и счётчик сообщений
-    incoming_type = _infer_msg_type(msg)  # определяем вид сообщения
-    save_message(  # сохраняем само входящее сообщение
-        chat_id=chat_id,
-        direction=0,  # 0 = входящее (от пользователя)
-        text=msg.text if incoming_type == "text" else None,  # текст сохраняем только если он есть
-        content_type=incoming_type,  # тип контента
-        attachment_name=(
-            getattr(msg.audio, "file_name", None)  # имя аудиофайла
-            or getattr(msg.document, "file_name", None)  # имя документа
-            or ("photo" if getattr(msg, "photo", None) else None)  # помета фото
-            or ("voice" if getattr(msg, "voice", None) else None)  # помета голосового
-        ),
-        message_id=getattr(msg, "message_id", None),  # телеграмный message_id (если нужен)
+def _attachment_name(voice, audio, photo, document):
+    """Имя вложения для БД: файл аудио/документа или пометка photo/voice."""
+    return (
+        getattr(audio, "file_name", None)  # имя аудиофайла
+        or getattr(document, "file_name", None)  # имя документа
+        or ("photo" if photo else None)  # помета фото
+        or ("voice" if voice else None)  # помета голосового
     )
 
+
+# --- авто-квиток (ACK) ---
+async def _send_ack(msg: Message, bot: Bot, chat_id: int) -> None:
     # 2) Авто-квиток (ACK) — редкий, чтобы не спамить.
     try:
         # Идея ACK: отправляем «квитанцию» не чаще кулдауна, чтобы не спамить.
-        if should_ack(chat_id):  # TTL хранится в Redis  # 🔴
-            async def _typing_ack() -> None:
-                # Короткая «печатает…», чтобы диалог ощущался живым.  # 🔴
-                try:
-                    loop = asyncio.get_event_loop()
-                    until = loop.time() + TELEGRAM_TYPING_ACK_DURATION_SEC
-                    while loop.time() < until:
-                        await bot.send_chat_action(chat_id, ChatAction.TYPING)
-                        await asyncio.sleep(4)
-                except Exception:
-                    # Не ломаем основной поток, просто гасим любые сбои.  # 🔴
-                    pass
-
-            task = asyncio.create_task(_typing_ack())
+        if await should_ack(chat_id):  # TTL хранится в Redis  # 🔴
+            # Сам текст квитанции уже показывает активность — отдельный
+            # «печатает…» перед ним только тратил лишний запрос к Telegram.  # 🔴
             await msg.answer(ACK_DELAYED)  # короткая квитанция  # 🔴
-            task.cancel()
     except Exception as e:
         # ACK – необязателен. Любая ошибка не блокирует сценарий.  # 🔴
         logging.warning("⚠️ ACK send failed: %s", e)
 
+
+# --- зеркало сообщения пользователя в amoCRM (Chat API v2) ---
+# Для нетекстовых вложений показываем тип, чтобы менеджер видел факт.  # 🔴
+# Диспетчер по результату _infer_msg_type — без цепочки elif и лишних strip().
+_AMO_MARKERS = {
+    "photo": lambda m: "[photo]",
+    "voice": lambda m: "[voice]",
+    "audio": lambda m: f"[audio] {m.audio.file_name}" if m.audio.file_name else "[audio]",
+    "document": lambda m: f"[file] {m.document.file_name}" if m.document.file_name else "[file]",
+    "text": lambda m: (m.text or "").strip(),
+}
+
+async def _mirror_to_amo(msg: Message, chat_id: int, incoming_type: str) -> None:
     # Дублируем сообщение пользователя в amoCRM как ЧАТ через Chat API v2.  # 🔴
     # Стратегия: если текст есть — отправляем его; если нет — короткую метку.  # 🔴
-    text_for_amo = (msg.text or "").strip()
-    if not text_for_amo:
-        # Для нетекстовых вложений показываем тип, чтобы менеджер видел факт.  # 🔴
-        if getattr(msg, "photo", None):
-            text_for_amo = "[photo]"
-        elif getattr(msg, "voice", None):
-            text_for_amo = "[voice]"
-        elif getattr(msg, "audio", None):
-            fname = getattr(getattr(msg, "audio", None), "file_name", "") or ""
-            text_for_amo = f"[audio] {fname}".strip()
-        elif getattr(msg, "document", None):
-            fname = getattr(getattr(msg, "document", None), "file_name", "") or ""
-            text_for_amo = f"[file] {fname}".strip()
-
-    scope_id = os.getenv("AMO_CHAT_SCOPE_ID", "").strip()  # 🔴
+    text_for_amo = _AMO_MARKERS[incoming_type](msg)
+
+    scope_id = AMO_CHAT_SCOPE_ID  # 🔴 прочитан один раз при импорте
     if text_for_amo and scope_id:
         # Ограничиваем длину (практичный предел для Chat API ~4k).  # 🔴
-        payload_text = text_for_amo[:4000]
+        payload_text = text_for_amo
+        if len(payload_text) > 4000:  # срез только когда он реально нужен
+            payload_text = payload_text[:4000]
         # Безопасно получаем имя отправителя (fallback — User <id>).  # 🔴
-        sender_name = (
-            getattr(getattr(msg, "from_user", None), "full_name", None)
-            or f"User {chat_id}"
-        )
+        fu = msg.from_user  # поле модели есть всегда, может быть None
+        sender_name = (fu.full_name if fu is not None else None) or f"User {chat_id}"
         try:
             ok = await send_chat_message_v2(
                 scope_id,
@@ -156,5 +126,33 @@ async def any_message(msg: Message, bot: Bot):
         except Exception as e:
             logging.warning("⚠️ ChatAPI v2 user msg mirror failed: %s", e)
 
+
+# --- обработчик любых сообщений ---
+@router.message()  # срабатывает на любое сообщение пользователя
+async def any_message(msg: Message, bot: Bot):
+    chat_id = msg.chat.id  # ID чата, откуда пришло сообщение
+
+    # --- фиксируем пользователя и входящее сообщение в БД (в фоне) ---
+    enqueue_db_write("user", msg)  # создаём/обновляем пользователя и счётчик сообщений
+    # вложения читаем из модели один раз и переиспользуем ниже  # 🔴
+    d = msg.__dict__  # поля pydantic-модели aiogram
+    attachments = (d.get("voice"), d.get("audio"), d.get("photo"), d.get("document"))
+    incoming_type = _infer_msg_type(*attachments)  # определяем вид сообщения
+    enqueue_db_write("message", dict(  # сохраняем само входящее сообщение
+        chat_id=chat_id,
+        direction=0,  # 0 = входящее (от пользователя)
+        text=msg.text if incoming_type == "text" else None,  # текст сохраняем только если он есть
+        content_type=incoming_type,  # тип контента
+        attachment_name=_attachment_name(*attachments),  # имя файла или пометка
+        message_id=getattr(msg, "message_id", None),  # телеграмный message_id (если нужен)
+    ))
+
+    # 2) ACK и 3) зеркало в amoCRM независимы — сетевые ожидания перекрываем.  # 🔴
+    # Оба хелпера сами гасят и логируют свои ошибки.
+    await asyncio.gather(
+        _send_ack(msg, bot, chat_id),
+        _mirror_to_amo(msg, chat_id, incoming_type),
+    )
+
     # Главная обработка ассистентом уходит в фон, чтобы не блокировать UX.  # 🔴
     asyncio.create_task(schedule_processing(msg, delay_sec=DELAY_SEC))
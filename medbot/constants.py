@@ -12,26 +12,40 @@ ALLOWED_ORIGINS = [  # 🔴 CORS источники
 ]
 
 TELEGRAM_TYPING_REFRESH_SEC = 4  # 🔴 как часто обновлять ChatAction
+TELEGRAM_GLOBAL_RPS = 25  # 🔴 запросов в секунду на бота (лимит Telegram ~30)
+TELEGRAM_GLOBAL_BURST = 30  # 🔴 допустимый всплеск на бота
+TELEGRAM_PER_CHAT_RPS = 1  # 🔴 сообщений в секунду в один чат
+TELEGRAM_PER_CHAT_BURST = 3  # 🔴 короткий всплеск в один чат (части ответа)
+TELEGRAM_RETRY_AFTER_ATTEMPTS = 3  # 🔴 попыток запроса при ответе 429 (retry_after)
 
 # --- OpenAI Delivery Splitting ---
-SPLIT_FIRST_LIMIT = 1500  # 🔴 первая часть ответа
-SPLIT_SECOND_LIMIT = 2500  # 🔴 вторая часть ответа
+SPLIT_CHUNK_LIMIT = 4000  # 🔴 часть ответа — почти весь лимит Telegram, меньше сообщений
+STREAM_FIRST_CHUNK_MIN_CHARS = 1200  # 🔴 с какой длины отдавать часть ответа прямо из стрима
 TELEGRAM_TEXT_LIMIT = 4096  # 🔴 жёсткий лимит Telegram
 
 # --- OpenAI Run statuses considered "active" ---
-ACTIVE_RUN_STATUSES = {
+ACTIVE_RUN_STATUSES = frozenset({  # 🔴 неизменяемое множество для проверок `in`
     "queued",
     "in_progress",
     "requires_action",
     "cancelling",
-}
+})
 
 # --- Redis keys ---
 REDIS_THREAD_KEY = "medbot:tchat:thread"
 REDIS_LAST_SEEN_KEY = "medbot:last_seen"
+# пометка: старые last_seen (время создания треда) уже перештампованы
+REDIS_LAST_SEEN_RESTAMPED_KEY = "medbot:last_seen:restamped"
 REDIS_ACK_ONCE_PREFIX = "medbot:ack:"
 REDIS_LAST_ACK_PREFIX = "medbot:last_ack:"
+REDIS_ACK_ONCE_HASH_PREFIX = "medbot:ackh:"  # + chat_id // ACK_HASH_BUCKET_SIZE (Redis >= 7.4)
+REDIS_LAST_ACK_HASH_PREFIX = "medbot:last_ackh:"  # + chat_id // ACK_HASH_BUCKET_SIZE (Redis >= 7.4)
 REDIS_LEAD_ID_KEY = "medbot:tchat:lead_id"
+REDIS_USERS_HLL_PREFIX = "medbot:users:"  # + YYYYMMDD: HyperLogLog активных chat_id за день
+REDIS_ANALYTICS_PREFIX = "medbot:analytics:"  # + from:to:approx — кэш сводки аналитики
+REDIS_USER_MSGCOUNT_KEY = "medbot:user_msgcount"  # chat_id → сообщений с последней сверки с БД
+REDIS_MSGCOUNT_LOCK_KEY = "medbot:user_msgcount:lock"  # один сверщик счётчиков на все процессы
+REDIS_MSGCOUNT_SNAPSHOTS_KEY = "medbot:user_msgcount:snapshots"  # SET ключей неприменённых снимков
 
 # --- Defaults ---
 DEFAULT_REPLY_DELAY_SEC = 60  # 🔴 задержка авто-ответа по умолчанию
@@ -42,22 +56,41 @@ DEFAULT_REPLY_DELAY_SEC = 60  # 🔴 задержка авто-ответа по
 HTTP_TIMEOUT_SEC = 10  # 🔴 общий таймаут HTTP-сессий
 AMO_REQUEST_TIMEOUT_SEC = 15  # 🔴 таймаут для amoCRM API
 TELEGRAM_FORWARD_TIMEOUT_SEC = 5  # 🔴 таймаут пересылки в amoCRM webhook
+AMO_WEBHOOK_MAX_BODY_BYTES = 1024 * 1024  # 🔴 потолок тела вебхука amojo
+
+# Очереди фоновой отправки
+CHAT_SEND_QUEUE_MAXSIZE = 1000  # 🔴 лимит очереди сообщений в amojo Chat API
+DB_WRITE_QUEUE_MAXSIZE = 10_000  # 🔴 лимит очереди фоновой записи в БД
+DB_WRITE_BATCH_MAX = 128  # 🔴 максимум записей в одной пачке INSERT
+DB_WRITE_LINGER_SEC = 0.1  # 🔴 сколько ждать добора пачки после первой записи
+USERS_HLL_TTL_SEC = 400 * 24 * 3600  # 🔴 сколько хранить дневные HLL пользователей
+USERS_HLL_MAX_DAYS = 400  # 🔴 максимум дней в одном PFCOUNT
+ANALYTICS_CACHE_TTL_SEC = 15  # 🔴 кэш сводки для окна, которое ещё идёт
+ANALYTICS_CACHE_CLOSED_TTL_SEC = 24 * 3600  # 🔴 кэш сводки для закрытого окна в прошлом
+LOG_BATCH_MAX_CHARS = 4000  # 🔴 сколько символов логов склеивать в одно сообщение
+LOG_QUEUE_MAXSIZE = 1000  # 🔴 сколько строк лога держать в очереди; сверх — отбрасываем
 
 # OpenAI обработка
 OPENAI_RUN_TIMEOUT_SEC = 600  # 🔴 максимальное время ожидания run (10 мин)
-OPENAI_RUN_POLL_INTERVAL_SEC = 2  # 🔴 интервал проверки статуса run
 OPENAI_THREAD_IDLE_TIMEOUT_SEC = 60  # 🔴 таймаут ожидания освобождения треда
-OPENAI_THREAD_IDLE_POLL_SEC = 0.4  # 🔴 интервал проверки треда
-
-# Тайпинг индикаторы
-TELEGRAM_TYPING_DURATION_SEC = 60  # 🔴 длительность показа "печатает..." во время обработки
-TELEGRAM_TYPING_ACK_DURATION_SEC = 20  # 🔴 длительность тайпинга для авто-квитка
-TELEGRAM_TYPING_RESPONSE_DURATION_SEC = 15  # 🔴 длительность тайпинга при отправке ответа
-TELEGRAM_TYPING_TAIL_DURATION_SEC = 10  # 🔴 длительность тайпинга для остальных частей
+OPENAI_THREAD_IDLE_POLL_SEC = 0.05  # 🔴 стартовый интервал проверки треда (дальше — backoff)
+OPENAI_POLL_BACKOFF_FACTOR = 1.7  # 🔴 рост интервала опроса после каждой проверки
+OPENAI_POLL_MAX_INTERVAL_SEC = 8.0  # 🔴 потолок интервала опроса
 
 # ACK (авто-квитки)
 ACK_COOLDOWN_SEC = 60  # 🔴 интервал между авто-квитками (1 минута)
 ACK_ONCE_TTL_SEC = 24 * 3600  # 🔴 время жизни пометки "уже отправили" (24 часа)
+ACK_HASH_BUCKET_SIZE = 500  # 🔴 чатов в одном хэше пометок (< hash-max-listpack-entries)
+
+# Кэш связок chat_id → thread_id / lead_id в памяти процесса (storage.py)
+STORAGE_CACHE_MAXSIZE = 10_000  # 🔴 сколько чатов держать
+STORAGE_CACHE_TTL_SEC = 60  # 🔴 через сколько перечитывать из Redis
+
+# Авточистка неактивных чатов (storage.gc_threads)
+THREAD_GC_MAX_AGE_SEC = 90 * 24 * 3600  # 🔴 неактивные > 90 дней
+THREAD_GC_INTERVAL_SEC = 24 * 3600  # 🔴 запуск раз в сутки
+MSGCOUNT_RECONCILE_SEC = 60  # 🔴 как часто переносить счётчики сообщений из Redis в users
+MSGCOUNT_RECONCILE_LOCK_TTL_SEC = 300  # 🔴 страховка: замок сверки живёт не дольше
 
 # Периодические задачи
 AMO_TOKEN_REFRESH_INTERVAL_SEC = 12 * 3600  # 🔴 интервал обновления токена (12 часов)
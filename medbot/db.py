@@ -49,3 +49,10 @@ class Message(Base):
     content_type = Column(String(32), nullable=False, default="text")
     attachment_name = Column(Text)
     created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+
+
+class MsgcountSnapshot(Base):
+    # снимки счётчиков Redis, уже прибавленные к users.messages_total
+    __tablename__ = "msgcount_snapshots"
+    snapshot = Column(Text, primary_key=True)
+    applied_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
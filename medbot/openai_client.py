@@ -1,34 +1,33 @@
 # openai_client.py
-import os, io, asyncio, time, traceback  # стандартные модули
+import os, io, asyncio, time, traceback, secrets  # стандартные модули
 import re  # для очистки/нормализации Markdown-разметки
 from pathlib import Path
 from dotenv import load_dotenv
-from typing import Optional, Tuple, List, Dict, Any
+from typing import Optional, Tuple, List, Dict, Any, BinaryIO
 from aiogram.types import Message  # тип входящего сообщения из Telegram
 from aiogram import Bot  # объект Telegram-бота (чтобы отправлять сообщения/действия)
 from aiogram.enums import ChatAction  # понадобится для отправки индикатора "печатает..."
-from openai import OpenAI  # официальный клиент OpenAI API
+from openai import AsyncOpenAI  # асинхронный клиент OpenAI API (не блокирует event loop)
 from storage import get_thread_id, set_thread_id  # функции сохранения/чтения
-from pydub import AudioSegment  # библиотека для работы со звуком (конвертации аудио)
-from repo import save_message  # функция записи сообщений в БД
+from repo import save_messages_bulk  # пакетная запись сообщений в БД
+from tg_rate_limit import TelegramRateLimiter  # 🔴 token bucket для лог-бота
 from texts import ACK_DELAYED  # 🔴 стандартное сообщение-врач (из texts.py)
-from storage import should_ack
+from storage import load_chat_state  # тред + lead + решение по ACK за один round-trip
 import logging  # 🔴
 from constants import (  # 🔴 централизованные константы
     TELEGRAM_TYPING_REFRESH_SEC,
-    SPLIT_FIRST_LIMIT,
-    SPLIT_SECOND_LIMIT,
+    SPLIT_CHUNK_LIMIT,
+    STREAM_FIRST_CHUNK_MIN_CHARS,
     TELEGRAM_TEXT_LIMIT,
     ACTIVE_RUN_STATUSES,
     OPENAI_RUN_TIMEOUT_SEC,
-    OPENAI_RUN_POLL_INTERVAL_SEC,
     OPENAI_THREAD_IDLE_TIMEOUT_SEC,
     OPENAI_THREAD_IDLE_POLL_SEC,
-    TELEGRAM_TYPING_DURATION_SEC,
-    TELEGRAM_TYPING_ACK_DURATION_SEC,
-    TELEGRAM_TYPING_RESPONSE_DURATION_SEC,
-    TELEGRAM_TYPING_TAIL_DURATION_SEC,
+    OPENAI_POLL_BACKOFF_FACTOR,
+    OPENAI_POLL_MAX_INTERVAL_SEC,
     ACK_COOLDOWN_SEC,
+    LOG_BATCH_MAX_CHARS,
+    LOG_QUEUE_MAXSIZE,
 )
 
 
@@ -44,21 +43,13 @@ if not OPENAI_API_KEY:  # если ключа нет — даём явную о
         "Add line: OPENAI_API_KEY=sk-... to your medbot/.env"
     )
 
-# Попытка подключить Redis для межпроцессного лока; если не установлен, используем in-memory локи
-try:
-    # redis-py 5.x
-    import redis.asyncio as aioredis  # асинхронный Redis-клиент
-except Exception:
-    try:
-        # redis-py 4.x стиль
-        from redis import asyncio as aioredis  # альтернатива импорту
-    except Exception:
-        aioredis = None  # фоллбек: будем использовать локи в памяти процесса
+from redis_client import ar  # общий асинхронный пул Redis (тот же, что у storage)
 
 # --- конфиг ---
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))  # 🔴 клиент OpenAI
+client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))  # 🔴 клиент OpenAI (async)
 ASSISTANT_ID = os.getenv("ASSISTANT_ID")  # ID настроенного ассистента в OpenAI (Assistant API)
 DELAY_SEC = int(os.getenv("REPLY_DELAY_SEC", "0"))  # базовая задержка ответа (сек), по умолчанию 0
+VOICE_AS_WAV = os.getenv("VOICE_AS_WAV", "0") == "1"  # перекодировать голосовые в WAV (по умолчанию — отдаём OGG как есть)
 
 # логирование: поддержка двух режимов
 LOG_CHAT_ID = (  # 🔴 чат для служебных логов
@@ -67,13 +58,37 @@ LOG_CHAT_ID = (  # 🔴 чат для служебных логов
 LOG_BOT_TOKEN = os.getenv("LOG_BOT_TOKEN", "")  # 🔴 токен бота для логов
 LOG_PREFIX = "[medbot]"  # префикс для сообщений в лог-чат
 
-# если задан отдельный токен для логов — поднимем отдельного бота один раз
-_log_bot: Optional[Bot] = Bot(LOG_BOT_TOKEN) if LOG_BOT_TOKEN else None  # создаём «бота для логов» или оставляем None
-
-# Redis-клиент (опционально) и in-memory локи
-REDIS_URL = os.getenv("REDIS_URL", "")  # строка подключения к Redis (если задана)
-_redis = aioredis.from_url(REDIS_URL, decode_responses=True) if (aioredis and REDIS_URL) else None  # клиент или None
-_local_locks: Dict[str, asyncio.Lock] = {}  # локи в памяти по thread_id
+# если задан отдельный токен для логов — поднимем отдельного бота один раз и лениво
+# (Bot открывает свою aiohttp-сессию — не создаём её при импорте и не плодим копии)
+_log_bot: Optional[Bot] = None
+
+def _get_log_bot() -> Optional[Bot]:  # единственный способ получить «бота для логов»
+    global _log_bot
+    if _log_bot is None and LOG_BOT_TOKEN:
+        _log_bot = Bot(LOG_BOT_TOKEN)
+        _log_bot.session.middleware(TelegramRateLimiter())  # свой лимит у отдельного бота
+    return _log_bot
+
+async def close_log_bot() -> None:  # закрываем сессию лог-бота на shutdown
+    if _log_bot is not None:
+        await _log_bot.session.close()
+
+# Redis-клиент для межпроцессных локов и in-memory локи (если клиента нет)
+_redis = ar  # тот же адрес и пул, что у storage: локи не расходятся с данными
+_local_locks: Dict[str, asyncio.Lock] = {}  # локи в памяти по thread_id (только занятые/ожидаемые)
+
+# Атомарное снятие лока: удаляем только свой токен и будим одного ждущего
+_UNLOCK_LUA = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    redis.call('del', KEYS[1])
+    redis.call('lpush', KEYS[2], '1')
+    redis.call('ltrim', KEYS[2], 0, 0)
+    redis.call('expire', KEYS[2], 120)
+    return 1
+end
+return 0
+"""
+_UNLOCK_SCRIPT = _redis.register_script(_UNLOCK_LUA) if _redis else None  # EVALSHA с кэшем скрипта
 
 
 # --- поддержка типов ---
@@ -92,6 +107,13 @@ RETRIEVAL_EXTS = {
     ".htm",
 }
 AUDIO_EXTS = {".wav", ".mp3", ".m4a", ".ogg", ".opus"}
+# расширение → вид вложения: один поиск в dict вместо трёх проверок по множествам
+# (при пересечении побеждает аудио, затем изображение — как в прежней цепочке if)
+_EXT_KIND: Dict[str, str] = (
+    {e: "doc" for e in RETRIEVAL_EXTS}
+    | {e: "image" for e in IMAGE_EXTS}
+    | {e: "audio" for e in AUDIO_EXTS}
+)
 
 # статусы «активного» run — при них нельзя добавлять новые сообщения в тред
 _ACTIVE_RUN_STATUSES = ACTIVE_RUN_STATUSES  # 🔴 используем из constants
@@ -111,73 +133,92 @@ def _log_run_error(run) -> None:
 # ---------- УТИЛИТЫ ДЛЯ ТАЙПИНГА И ОЧИСТКИ/НАРЕЗКИ ОТВЕТОВ ----------
 
 
-async def _typing_for(bot: Bot, chat_id: int, seconds: float) -> None:
-    """Поддерживаем индикатор печати нужное время, отправляя ChatAction.TYPING раз в ~4 сек."""
-    end_at = time.time() + max(0.0, seconds)  # когда прекратить
-    while time.time() < end_at:
-        try:
-            await bot.send_chat_action(chat_id, ChatAction.TYPING)  # показать "печатает..."
-        except Exception:
-            pass  # не роняем обработку при сетевых/транзиентных ошибках
+async def _typing_once(bot: Bot, chat_id: int) -> None:
+    """Один ChatAction.TYPING: Telegram сам гасит индикатор через ~5 сек или при сообщении."""
+    try:
+        await bot.send_chat_action(chat_id, ChatAction.TYPING)
+    except Exception:
+        pass  # индикатор косметический — ошибки не важны
+
+async def _typing_loop(bot: Bot, chat_id: int) -> None:
+    """Держим индикатор печати, пока задачу не отменят: ChatAction.TYPING раз в ~4 сек."""
+    while True:
+        await _typing_once(bot, chat_id)  # показать "печатает..."
         await asyncio.sleep(TELEGRAM_TYPING_REFRESH_SEC)  # 🔴
 
-_MD_STRIP_PATTERNS = [  # шаблоны Markdown, которые нужно скрыть от пользователя
-    (r"\*{2}(.+?)\*{2}", r"\1"),   # **жирный** → жирный (без **)
-    (r"#{1,6}\s*", ""),            # заголовки вида ### Title → Title
-    (r"^-{3,}\s*$", ""),           # --- (горизонтальная линия) → удалить
-    (r"`{3}.*?`{3}", ""),          # код-блок ```...``` → удалить содержимое (простое поведение)
-    (r"`([^`]+)`", r"\1"),         # инлайн-код `x` → x
-]
+def _start_typing(bot: Bot, chat_id: int) -> asyncio.Task:
+    """Фоновый typing на время реальной работы; вызывающий делает task.cancel(), когда ответ готов."""
+    return asyncio.create_task(_typing_loop(bot, chat_id))
+
+# шаблоны Markdown, которые нужно скрыть от пользователя — одна альтернатива,
+# чтобы весь ответ проходился регуляркой один раз (скомпилирована при импорте)
+# DOTALL не включаем глобально: переводы строк пересекает только код-блок,
+# и он записан без ленивого .*? — тело из «не-```», без взрыва возвратов
+_MD_RE = re.compile(
+    r"\*{2}(?P<bold>[^*\n]+?)\*{2}"  # **жирный** → жирный (без **), в пределах строки
+    r"|#{1,6}\s*"                    # заголовки вида ### Title → Title
+    r"|^-{3,}\s*$"                   # --- (горизонтальная линия) → удалить
+    r"|```(?:[^`]|`(?!``))*```"      # код-блок ```...``` → удалить содержимое (простое поведение)
+    r"|`(?P<code>[^`]+)`",           # инлайн-код `x` → x
+    re.MULTILINE,
+)
+
+def _md_repl(m: "re.Match[str]") -> str:  # что оставить на месте совпадения
+    bold = m.group("bold")
+    if bold is not None:
+        return bold
+    code = m.group("code")
+    return code if code is not None else ""
+
+_MD_SENTINEL = re.compile(r"[*#`]|---")  # есть ли вообще символы разметки
 
 def _sanitize_markdown(text: str) -> str:  # удаляет/облегчает Markdown-разметку
     s = text or ""  # безопасно работаем с None
-    for pat, repl in _MD_STRIP_PATTERNS:  # прогон по шаблонам
-        s = re.sub(pat, repl, s, flags=re.MULTILINE | re.DOTALL)  # замена по всему тексту
-    return s.strip()  # финальная нормализация пробелов/краёв
+    if not _MD_SENTINEL.search(s):  # обычный текст без разметки — регулярку не запускаем
+        return s.strip()
+    return _MD_RE.sub(_md_repl, s).strip()  # один проход + нормализация краёв
+
+_BOUND_RE = re.compile(r"[.!?] |\n")  # граница предложения или перенос строки
 
 def _split_for_delivery(text: str) -> List[str]:
     """
     Режет длинный текст на части, не разрывая предложения.
-    Приблизительно: 1500 / 2500 / остаток.
+    Каждая часть — до SPLIT_CHUNK_LIMIT символов (чуть меньше лимита Telegram).
     Если подходящей точки не найдено, делит по лимиту.
     """
     t = text.strip() if text else ""
     if not t:
         return []
 
-    def _safe_cut(segment: str, limit: int) -> str:
-        """🔴 Ищет ближайший конец предложения перед лимитом."""
-        if len(segment) <= limit:
-            return segment
-        cut = segment[:limit]
-        # ищем последнюю "границу предложения"
-        for p in [". ", "! ", "? ", "\n"]:
-            pos = cut.rfind(p)
-            if pos != -1 and pos > limit * 0.6:  # если нашли и не слишком рано
-                return cut[: pos + len(p)].strip()
-        return cut.strip()  # fallback — просто обрезаем
+    n = len(t)
+    limit = SPLIT_CHUNK_LIMIT  # 🔴 лимит из constants
+    # 🔴 все "границы предложений" находим одним проходом по тексту,
+    # дальше только двигаем указатель по списку (start, end)
+    spans = [m.span() for m in _BOUND_RE.finditer(t)]
+    bi = 0  # первая ещё не пройденная граница
 
     parts: List[str] = []
-    remaining = t
-
-    # 🔴 Первая часть по лимиту из constants
-    first = _safe_cut(remaining, SPLIT_FIRST_LIMIT)  # 🔴
-    parts.append(first)
-    remaining = remaining[len(first):].strip()
-
-    # 🔴 Вторая часть по лимиту из constants
-    if remaining:
-        second = _safe_cut(remaining, SPLIT_SECOND_LIMIT)  # 🔴
-        parts.append(second)
-        remaining = remaining[len(second):].strip()
-
-    # 🔴 Остаток по лимиту Telegram из constants
-    while remaining:
-        chunk = _safe_cut(remaining, TELEGRAM_TEXT_LIMIT)  # 🔴
-        parts.append(chunk)
-        remaining = remaining[len(chunk):].strip()
-
-    return [p for p in parts if p]
+    pos = 0  # курсор по t — хвост не копируем на каждой итерации
+    while pos < n:
+        end = pos + limit
+        if end >= n:
+            end = n  # остаток целиком влезает
+        else:
+            floor = pos + int(limit * 0.6) + 1  # раньше 60% лимита резать не хотим
+            while bi < len(spans) and spans[bi][0] < floor:
+                bi += 1
+            j = bi
+            while j < len(spans) and spans[j][1] <= end:
+                j += 1
+            if j > bi:
+                end = spans[j - 1][1]  # последняя граница в окне
+            bi = j  # fallback (границы нет) — просто обрезаем по лимиту
+        parts.append(t[pos:end].rstrip())
+        pos = end
+        while pos < n and t[pos].isspace():  # пропускаем пробелы между частями
+            pos += 1
+
+    return parts
 
 
 # --- треды ---
@@ -187,84 +228,159 @@ async def ensure_thread_choice(chat_id: int, choice: str) -> bool:  # прове
     и сохраняем его ID в Redis. Возвращает True, если создан новый тред.
     """
     if choice == "новый":  # если пользователь выбрал начать новый диалог
-        th = client.beta.threads.create()  # создаём новый тред (сессию) в OpenAI
-        set_thread_id(chat_id, th.id)  # сохраняем ID треда для этого чата
+        th = await client.beta.threads.create()  # создаём новый тред (сессию) в OpenAI
+        await set_thread_id(chat_id, th.id)  # сохраняем ID треда для этого чата
         return True  # сообщаем, что тред был создан
     return False  # иначе — ничего не создавали
 
-def get_or_create_thread(chat_id: int) -> str:  # возвращает существующий тред или создаёт новый
+async def get_or_create_thread(chat_id: int, stored: Optional[str] = None) -> str:  # возвращает существующий тред или создаёт новый
     """
     Возвращает существующий thread_id для чата,
     либо создаёт новый, если его нет.
+    stored — thread_id, уже прочитанный вызывающим (например, load_chat_state).
     """
-    th = get_thread_id(chat_id)  # пытаемся взять сохранённый thread_id из хранилища
+    th = stored or await get_thread_id(chat_id)  # сохранённый thread_id (кэш storage → Redis)
     if th:  # если найден
         return th  # возвращаем его
-    th_obj = client.beta.threads.create()  # иначе создаём новый тред в OpenAI
-    set_thread_id(chat_id, th_obj.id)  # сохраняем новый ID
+    th_obj = await client.beta.threads.create()  # иначе создаём новый тред в OpenAI
+    await set_thread_id(chat_id, th_obj.id)  # сохраняем новый ID
     return th_obj.id  # и возвращаем его
 
 def _ext(name: str) -> str:  # утилита: получить расширение файла
-    return Path(name).suffix.lower()  # 🔴 pathlib.Path → Path
-
-def _is_image(name: str) -> bool:  # проверка: это изображение?
-    return _ext(name) in IMAGE_EXTS  # да, если расширение в списке IMAGE_EXTS
-
-def _is_audio(name: str) -> bool:  # проверка: это аудио?
-    return _ext(name) in AUDIO_EXTS  # да, если расширение в списке AUDIO_EXTS
-
-def _is_retrieval_doc(name: str) -> bool:  # проверка: это документ для «поиска по файлам»?
-    return _ext(name) in RETRIEVAL_EXTS  # да, если расширение в списке RETRIEVAL_EXTS
+    i = name.rfind(".")  # 🔴 чистая работа со строкой, без Path/splitext
+    return name[i:].lower() if i >= 0 else ""
 
 # --- util: лог в служебный чат ---
-async def send_log(runtime_bot: Bot, text: str) -> None:  # отправляет строку лога в служебный Telegram-чат
-    """Отправляет сообщение в лог-чат.
-    - Если есть LOG_BOT_TOKEN — шлём через отдельного бота (_log_bot)
-    - Иначе — через runtime_bot (основной бот)
+_LOG_Q: "asyncio.Queue[str]" = asyncio.Queue(maxsize=LOG_QUEUE_MAXSIZE)  # строки лога ждут фоновой отправки
+
+def send_log_nowait(runtime_bot: Bot, text: str) -> None:  # ставит строку лога в очередь служебного чата
+    """Кладёт сообщение в очередь лог-чата (отправляет log_drain_worker) и сразу возвращает управление.
+    - runtime_bot оставлен для совместимости вызовов: бот задаётся при старте воркера
     - chat_id = LOG_CHAT_ID или ADMIN_CHAT_ID
+    - очередь переполнена (лог-чат недоступен) — строку теряем, пользователя не задерживаем
     """
     if not LOG_CHAT_ID:  # если лог-чат не задан — ничего не делаем
         return
     try:
-        bot = _log_bot or runtime_bot  # выбираем бота: отдельного для логов или текущего
-        await bot.send_message(LOG_CHAT_ID, f"{LOG_PREFIX} {text}")  # отправляем сообщение в лог-чат
-    except Exception:  # любые ошибки логирования не должны ломать основную логику
-        # не падаем на логах
+        _LOG_Q.put_nowait(f"{LOG_PREFIX} {text}")  # не ждём Telegram на горячем пути
+    except asyncio.QueueFull:
         pass
 
-def _upload_bytes(name: str, data: bytes) -> str:  # загрузка произвольного файла в OpenAI и возврат его file_id
-    return client.files.create(file=(name, io.BytesIO(data)), purpose="assistants").id  # создаём файл в OpenAI под ассистентов
-
-async def _telegram_file_to_bytes(msg: Message) -> Tuple[str, bytes]:  # скачивает файл из Telegram и возвращает (имя, байты)
-    if getattr(msg, "voice", None):  # если это голосовое сообщение
-        f = await msg.bot.get_file(msg.voice.file_id)  # получаем метаданные файла
-        b = await msg.bot.download_file(f.file_path)  # скачиваем содержимое
-        raw = b.read()  # читаем байты
-        wav = AudioSegment.from_file(io.BytesIO(raw))  # открываем аудио с авто-определением формата
-        buf = io.BytesIO()  # создаём буфер в памяти
-        wav.export(buf, format="wav")  # конвертируем в WAV (удобно для распознавания)
-        return "voice.wav", buf.getvalue()  # возвращаем имя и байты WAV
-    if getattr(msg, "audio", None):  # если это обычный аудиофайл
-        f = await msg.bot.get_file(msg.audio.file_id)  # получаем метаданные
-        b = await msg.bot.download_file(f.file_path)  # скачиваем
-        return (msg.audio.file_name or "audio.mp3"), b.read()  # возвращаем имя (если нет — дефолт) и байты
-    if getattr(msg, "document", None):  # если прислали документ (PDF, DOCX и т.д.)
-        f = await msg.bot.get_file(msg.document.file_id)  # получаем метаданные
-        b = await msg.bot.download_file(f.file_path)  # скачиваем
-        return (msg.document.file_name or "document"), b.read()  # возвращаем имя или "document" и байты
-    if getattr(msg, "photo", None):  # если прислали фото
-        f = await msg.bot.get_file(msg.photo[-1].file_id)  # берём самую большую версию изображения
-        b = await msg.bot.download_file(f.file_path)  # скачиваем
-        return "photo.jpg", b.read()  # возвращаем дефолтное имя и байты
-    return "message.txt", (msg.text or "").encode("utf-8")  # если файла нет — упаковываем текст сообщения в txt
+async def log_drain_worker(runtime_bot: Bot) -> None:
+    """Фоновая отправка логов: накопившиеся строки склеиваются в одно сообщение.
+    - Если есть LOG_BOT_TOKEN — шлём через отдельного бота (_get_log_bot)
+    - Иначе — через runtime_bot (основной бот)
+    """
+    bot = _get_log_bot() or runtime_bot  # выбираем бота: отдельного для логов или основного
+    pending: Optional[str] = None  # строка, не влезшая в прошлую пачку
+    while True:
+        line = pending if pending is not None else await _LOG_Q.get()
+        pending = None
+        buf, size = [line], len(line)
+        while not _LOG_Q.empty():  # забираем всё, что успело накопиться
+            nxt = _LOG_Q.get_nowait()
+            if size + 1 + len(nxt) > LOG_BATCH_MAX_CHARS:
+                pending = nxt  # уйдёт следующей пачкой
+                break
+            buf.append(nxt)
+            size += 1 + len(nxt)
+        try:
+            await bot.send_message(LOG_CHAT_ID, "\n".join(buf)[:TELEGRAM_TEXT_LIMIT])
+        except Exception:  # любые ошибки логирования не должны ломать основную логику
+            pass
+
+async def _upload_bytes(name: str, data: BinaryIO) -> str:  # загрузка произвольного файла в OpenAI и возврат его file_id
+    data.seek(0)  # тот же буфер, что скачали из Telegram — без копии
+    f = await client.files.create(file=(name, data), purpose="assistants")  # создаём файл в OpenAI под ассистентов
+    return f.id  # возвращаем file_id
+
+def _convert_to_wav(src: BinaryIO) -> BinaryIO:  # синхронная конвертация через pydub/ffmpeg (для to_thread)
+    from pydub import AudioSegment  # ленивый импорт: нужен только при VOICE_AS_WAV=1
+    wav = AudioSegment.from_file(src)  # открываем аудио с авто-определением формата
+    buf = io.BytesIO()  # создаём буфер в памяти
+    wav.export(buf, format="wav")  # конвертируем в WAV прямо в буфер
+    buf.seek(0)
+    return buf  # сам буфер, без копии через getvalue()
+
+def _probe_attachment(msg: Message) -> Tuple[Any, Optional[str]]:  # одно вложение сообщения и его вид (или None)
+    if att := msg.voice:
+        return att, "voice"
+    if att := msg.audio:
+        return att, "audio"
+    if att := msg.document:
+        return att, "document"
+    if msg.photo:
+        return msg.photo[-1], "photo"  # берём самую большую версию изображения
+    return None, None
+
+async def _telegram_file_to_bytes(bot: Bot, att: Any, kind: str) -> Tuple[str, BinaryIO]:  # скачивает вложение из Telegram и возвращает (имя, буфер)
+    f = await bot.get_file(att.file_id)  # получаем метаданные файла
+    b = await bot.download_file(f.file_path)  # скачиваем содержимое (BytesIO)
+    if kind == "voice":  # голосовое сообщение
+        if not VOICE_AS_WAV:  # Whisper сам понимает OGG/Opus — без ffmpeg и WAV в ~10 раз больше
+            return "voice.ogg", b
+        # WAV нужен явно — ffmpeg в отдельном потоке, чтобы не блокировать event loop
+        return "voice.wav", await asyncio.to_thread(_convert_to_wav, b)
+    if kind == "audio":  # обычный аудиофайл
+        return (att.file_name or "audio.mp3"), b  # имя (если нет — дефолт) и буфер
+    if kind == "document":  # документ (PDF, DOCX и т.д.)
+        return (att.file_name or "document"), b  # имя или "document" и буфер
+    return "photo.jpg", b  # фото — дефолтное имя и буфер
+
+def _outbound_row(chat_id: int, text: str, content_type: str, sent) -> Dict[str, Any]:  # строка для save_messages_bulk
+    return {
+        "chat_id": chat_id,
+        "direction": 1,  # бот → пользователь
+        "text": text,
+        "content_type": content_type,
+        "attachment_name": None,
+        "message_id": getattr(sent, "message_id", None),
+    }
 
 def _first_text(messages) -> Optional[str]:  # достаёт первый текстовый ответ ассистента из истории
-    for m in messages.data:  # проходим по сообщениям
-        if getattr(m, "role", None) == "assistant":  # ищем сообщения от ассистента
-            for part in m.content:  # у сообщения может быть несколько частей (текст/картинки и т.п.)
-                if part.type == "text":  # нас интересует текстовая часть
-                    return part.text.value  # возвращаем текст
-    return None  # если текста не нашли
+    return next(  # первый текстовый кусок первого сообщения ассистента (или None)
+        (part.text.value
+         for m in messages.data if getattr(m, "role", None) == "assistant"
+         for part in m.content if part.type == "text"),
+        None,
+    )
+
+
+def _early_cut(text: str, floor: int) -> int:  # где отрезать готовую часть из стрима (0 — ещё рано)
+    end = 0
+    # последняя граница предложения в окне [floor, SPLIT_CHUNK_LIMIT)
+    for m in _BOUND_RE.finditer(text, floor, SPLIT_CHUNK_LIMIT):
+        end = m.end()
+    if end and text.count("```", 0, end) % 2:  # не режем посреди код-блока
+        return 0
+    return end
+
+async def _collect_text_deltas(stream, out: List[str], ship=None) -> str:  # копит текстовые дельты стрима run
+    """Складывает дельты в out. Если передан ship(part) — готовые части (до границы
+    предложения) отдаются сразу, не дожидаясь конца run: первая — уже от
+    STREAM_FIRST_CHUNK_MIN_CHARS, следующие — крупные, как у _split_for_delivery.
+    Возвращает ещё не отданный хвост текста."""
+    pending: List[str] = []  # текст после последней отданной части
+    size = 0
+    floor = STREAM_FIRST_CHUNK_MIN_CHARS  # первая часть — пораньше
+    async for delta in stream.text_deltas:
+        out.append(delta)
+        if ship is None:
+            continue
+        pending.append(delta)
+        size += len(delta)
+        if size < floor or floor > SPLIT_CHUNK_LIMIT:
+            continue
+        text = "".join(pending)
+        cut = _early_cut(text, floor)
+        if cut:
+            await ship(text[:cut])
+            text = text[cut:]
+            floor = int(SPLIT_CHUNK_LIMIT * 0.6)  # дальше — меньше сообщений
+        elif size >= SPLIT_CHUNK_LIMIT:  # границы так и нет — остаток режет _split_for_delivery
+            floor = SPLIT_CHUNK_LIMIT + 1  # больше из стрима не отдаём, только копим хвост
+        pending, size = [text], len(text)
+    return "".join(pending)
 
 
 # --- помощь: локи по thread_id ---
@@ -272,46 +388,74 @@ def _first_text(messages) -> Optional[str]:  # достаёт первый те
 async def _acquire_thread_lock(thread_id: str):  # пытаемся захватить лок по треду
     if _redis:
         key = f"medbot:lock:thread:{thread_id}"  # ключ лока в Redis
+        token = secrets.token_hex(16)  # уникальное значение — снять лок может только владелец
         while True:
-            ok = await _redis.set(key, "1", ex=120, nx=True)  # set NX + TTL
+            ok = await _redis.set(key, token, ex=120, nx=True)  # set NX + TTL
             if ok:
-                return key  # получили лок
-            await asyncio.sleep(0.2)  # ждём освобождения
+                return key, token  # получили лок
+            # ждём сигнала об освобождении вместо опроса; таймаут — страховка
+            # на случай, когда лок снят по TTL (упавший держатель) без сигнала
+            await _redis.blpop(f"{key}:rel", timeout=5)
     else:
         lock = _local_locks.setdefault(thread_id, asyncio.Lock())  # получаем/создаём лок в памяти
         await lock.acquire()
         return lock  # вернём сам лок-объект
 
+async def _release_thread_lock(thread_id: str, lock_token) -> None:  # освобождение лока
+    if _redis and isinstance(lock_token, tuple):
+        key, token = lock_token
+        try:
+            # compare-and-delete: если TTL истёк и лок уже чужой — не трогаем
+            await _UNLOCK_SCRIPT(keys=[key, f"{key}:rel"], args=[token])
+        except Exception:
+            pass
+    elif isinstance(lock_token, asyncio.Lock):
+        try:
+            lock_token.release()  # отпускаем лок в памяти процесса
+        except Exception:
+            pass
+        # никто не держит и не ждёт — убираем лок из словаря, чтобы он не рос бесконечно
+        if (
+            not lock_token.locked()
+            and not getattr(lock_token, "_waiters", None)
+            and _local_locks.get(thread_id) is lock_token
+        ):
+            del _local_locks[thread_id]
+
 # --- помощь: ожидание idle и ретраи messages.create ---
 
-def _has_active_runs(runs_list) -> bool:  # проверка: есть ли активные run’ы в треде
-    return any(getattr(r, "status", None) in _ACTIVE_RUN_STATUSES for r in runs_list.data)  # true, если есть активные
+def _oldest_active_run(runs_list):  # один проход: «самый старый» активный run или None (тогда тред свободен)
+    oldest = None
+    for r in runs_list.data:  # список приходит отсортированным по дате (новые сверху)
+        if r.status in _ACTIVE_RUN_STATUSES:  # status есть у Run всегда
+            oldest = r  # последний найденный — самый старый
+    return oldest
 
-def _find_oldest_active(runs_list):  # найти «самый старый» активный run (на всякий)
-    actives = [r for r in runs_list.data if getattr(r, "status", None) in _ACTIVE_RUN_STATUSES]
-    return actives[-1] if actives else None  # список приходит отсортированным по дате у OpenAI SDK (новые сверху)
+def _next_interval(cur: float) -> float:  # экспоненциальный рост паузы опроса с потолком
+    return min(cur * OPENAI_POLL_BACKOFF_FACTOR, OPENAI_POLL_MAX_INTERVAL_SEC)
 
-async def _wait_thread_idle(thread_id: str, timeout_s: int = 60, poll_s: float = 0.4):  # дожидаемся, пока тред будет «свободен»
+async def _wait_thread_idle(thread_id: str, timeout_s: int = OPENAI_THREAD_IDLE_TIMEOUT_SEC, poll_s: float = OPENAI_THREAD_IDLE_POLL_SEC):  # дожидаемся, пока тред будет «свободен»
     start = time.time()  # отметка времени
+    list_runs = client.beta.threads.runs.list  # цепочку атрибутов проходим один раз
     while True:
-        runs = client.beta.threads.runs.list(thread_id=thread_id, limit=10)  # смотрим активные run’ы
-        if not _has_active_runs(runs):  # если активных нет — выходим
+        runs = await list_runs(thread_id=thread_id, limit=10)  # смотрим активные run’ы
+        oldest = _oldest_active_run(runs)  # 🔴 один проход по списку на опрос
+        if oldest is None:  # если активных нет — выходим
             return
-        if time.time() - start > timeout_s:  # таймаут ожидания
-            oldest = _find_oldest_active(runs)  # попробуем отменить «старый» run
-            if oldest:
-                try:
-                    client.beta.threads.runs.cancel(thread_id=thread_id, run_id=oldest.id)  # мягкая отмена
-                except Exception:
-                    pass
+        if time.time() - start > timeout_s:  # таймаут ожидания — попробуем отменить «старый» run
+            try:
+                await client.beta.threads.runs.cancel(thread_id=thread_id, run_id=oldest.id)  # мягкая отмена
+            except Exception:
+                pass
             await asyncio.sleep(2)  # короткая пауза после cancel
             return  # выходим — пусть верхний уровень решает, что делать дальше
         await asyncio.sleep(poll_s)  # повторная проверка чуть позже
+        poll_s = _next_interval(poll_s)  # 🔴 каждая следующая проверка реже
 
 async def _messages_create_with_retry(thread_id: str, content, attachments=None, max_attempts: int = 3):  # безопасная отправка сообщения с ретраями
     for attempt in range(max_attempts):
         try:
-            client.beta.threads.messages.create(  # добавляем сообщение пользователя в тред OpenAI
+            await client.beta.threads.messages.create(  # добавляем сообщение пользователя в тред OpenAI
                 thread_id=thread_id,
                 role="user",
                 content=content,
@@ -327,145 +471,146 @@ async def _messages_create_with_retry(thread_id: str, content, attachments=None,
             raise  # если другая ошибка или исчерпали попытки — пробрасываем
 
 
-# Проверим, какой механизм лока активен (для логов / самодиагностики)
-try:
-    bot_for_log = _log_bot or (Bot(LOG_BOT_TOKEN) if LOG_BOT_TOKEN else None)
-    if bot_for_log and LOG_CHAT_ID:
-        msg = "Redis lock backend: ENABLED" if _redis else "Redis lock backend: DISABLED (using in-memory)"
-        asyncio.create_task(send_log(bot_for_log, msg))  # отправим сообщение в лог-чат асинхронно
-except Exception:
-    pass  # на случай, если лог-бот не инициализирован при старте
+def log_lock_backend(runtime_bot: Bot) -> None:  # какой механизм лока активен (для логов / самодиагностики)
+    send_log_nowait(
+        runtime_bot,
+        "Redis lock backend: ENABLED" if _redis else "Redis lock backend: DISABLED (using in-memory)",
+    )
+
+
+# --- подготовка содержимого сообщения для OpenAI (вложения, расшифровка) ---
+async def _build_content(msg: Message) -> Tuple[List[Dict[str, Any]], Optional[List[Dict[str, Any]]]]:
+    """Скачивает/загружает вложение и собирает content + attachments для messages.create."""
+    base_text = msg.text or "Проанализируй вложение и ответь как медицинский консультант."
+    content: List[Dict[str, Any]] = [{"type": "text", "text": base_text}]
+    attachments = None
+
+    # 🔴 Обработка вложений
+    att, att_kind = _probe_attachment(msg)  # 🔴 один обход атрибутов сообщения
+    if att is not None:
+
+        name, data = await _telegram_file_to_bytes(msg.bot, att, att_kind)
+        kind = _EXT_KIND.get(_ext(name))  # "audio" / "image" / "doc" / None
+
+        if kind == "audio":  # аудио только расшифровываем — в Files его не грузим
+            try:
+                data.seek(0)
+                tr = await client.audio.transcriptions.create(model="whisper-1", file=(name, data))
+                text = tr.text.strip() if getattr(tr, "text", None) else ""
+            except Exception:
+                text = ""
+            if not text:
+                text = "Не удалось автоматически распознать голосовое сообщение."
+            content = [{"type": "text",
+                        "text": f"Расшифровка голосового ({name}):\n{text}\n\nОтветь как медицинский консультант."}]
+            return content, attachments
+
+        fid = await _upload_bytes(name, data)
+
+        if kind == "image":
+            content.append({"type": "image_file", "image_file": {"file_id": fid}})
+        elif kind == "doc":
+            attachments = [{"file_id": fid, "tools": [{"type": "file_search"}]}]
+            content[0]["text"] = f"{base_text}\n\nУчти документ: {name}"
+        else:
+            content[0]["text"] = f"{base_text}\n\n(Файл {name} загружен; если нужно, укажите правильный формат.)"
+
+    return content, attachments
 
 
 # --- основная задача ---
 async def schedule_processing(msg: Message, delay_sec: Optional[int] = None) -> None:
     """Основной конвейер обработки сообщений пользователя."""
+    prep: Optional[asyncio.Task] = None  # подготовка вложения идёт параллельно остальному
+    typing_task: Optional[asyncio.Task] = None  # фоновый индикатор «печатает...»
+    outbound_log: List[Dict[str, Any]] = []  # исходящие сообщения — в БД одной пачкой в конце
     try:
         delay = int(delay_sec if delay_sec is not None else DELAY_SEC)
         if delay > 0:
             await asyncio.sleep(delay)
 
         chat_id = msg.chat.id
-        thread_id = get_or_create_thread(chat_id)
-        await send_log(msg.bot, f"DEBUG ACK check={should_ack(chat_id, 3600)} chat_id={chat_id}")
-
-        # 🔴 Отправляем ACK (раз в минуту)
-        if should_ack(chat_id, cooldown_sec=ACK_COOLDOWN_SEC):  # 🔴 используем константу
-            typing_task = asyncio.create_task(
-                _typing_for(msg.bot, chat_id, TELEGRAM_TYPING_ACK_DURATION_SEC)
-            )  # 🔴 фоновый typing с константой
-            await asyncio.sleep(TELEGRAM_TYPING_ACK_DURATION_SEC)  # 🔴
-            typing_task.cancel()
+        # 🔴 скачивание из Telegram и загрузка в OpenAI стартуют сразу и идут,
+        # пока мы получаем тред, ждём паузу ACK, лок и освобождение треда
+        prep = asyncio.create_task(_build_content(msg))
+        # 🔴 тред и решение по ACK — одним pipeline в Redis
+        stored_thread, _lead_id, ack_due = await load_chat_state(chat_id, cooldown_sec=ACK_COOLDOWN_SEC)
+        thread_id = await get_or_create_thread(chat_id, stored_thread)
+        send_log_nowait(msg.bot, f"DEBUG ACK check={ack_due} chat_id={chat_id}")
+
+        # 🔴 Отправляем ACK (раз в минуту) — сразу, без искусственной паузы
+        if ack_due:  # 🔴 кулдаун ACK_COOLDOWN_SEC
             ack_msg = await msg.answer(ACK_DELAYED)
-            save_message(
-                chat_id=chat_id,
-                direction=1,
-                text=ACK_DELAYED,
-                content_type="system",
-                message_id=getattr(ack_msg, "message_id", None),
-            )
-
-        base_text = msg.text or "Проанализируй вложение и ответь как медицинский консультант."
-        content: List[Dict[str, Any]] = [{"type": "text", "text": base_text}]
-        attachments = None
-
-        # 🔴 Обработка вложений
-        if any([getattr(msg, "voice", None),
-                getattr(msg, "audio", None),
-                getattr(msg, "document", None),
-                getattr(msg, "photo", None)]):
-
-            name, data = await _telegram_file_to_bytes(msg)
-            fid = _upload_bytes(name, data)
+            outbound_log.append(_outbound_row(chat_id, ACK_DELAYED, "system", ack_msg))
 
-            if _is_image(name):
-                content.append({"type": "image_file", "image_file": {"file_id": fid}})
-            elif _is_audio(name):
-                try:
-                    tr = client.audio.transcriptions.create(model="whisper-1", file=(name, io.BytesIO(data)))
-                    text = tr.text.strip() if getattr(tr, "text", None) else ""
-                except Exception:
-                    text = ""
-                if not text:
-                    text = "Не удалось автоматически распознать голосовое сообщение."
-                content = [{"type": "text",
-                            "text": f"Расшифровка голосового ({name}):\n{text}\n\nОтветь как медицинский консультант."}]
-            elif _is_retrieval_doc(name):
-                attachments = [{"file_id": fid, "tools": [{"type": "file_search"}]}]
-                content[0]["text"] = f"{base_text}\n\nУчти документ: {name}"
-            else:
-                content[0]["text"] = f"{base_text}\n\n(Файл {name} загружен; если нужно, укажите правильный формат.)"
-
-        # 🔴 Отправка в OpenAI
+        # 🔴 Отправка в OpenAI; typing крутится в фоне, пока ждём лок, вложение и run
+        typing_task = _start_typing(msg.bot, chat_id)
         lock_token = await _acquire_thread_lock(thread_id)
         try:
-            await _wait_thread_idle(thread_id, timeout_s=OPENAI_THREAD_IDLE_TIMEOUT_SEC)  # 🔴
+            # тред обычно свободен: сразу пишем сообщение, а ожидание idle —
+            # только если OpenAI ответил 400 «while a run is active» (см. ретраи)
+            content, attachments = await prep  # к этому моменту обычно уже готово
             await _messages_create_with_retry(thread_id, content, attachments, max_attempts=3)
 
-            # 🔴 фоновый typing во время запроса ассистента
-            typing_task = asyncio.create_task(
-                _typing_for(msg.bot, chat_id, TELEGRAM_TYPING_DURATION_SEC)
-            )  # 🔴 используем константу
+            # 🔴 Стрим run: события приходят по SSE сразу, без опроса runs.retrieve
+            deltas: List[str] = []  # куски текста ответа по мере генерации
+            shipped = 0  # сколько частей уже ушло пользователю прямо из стрима
+            tail = ""  # не отданный из стрима остаток
+
+            async def _ship(part: str) -> None:  # первая (и следующие) части — как только готовы
+                nonlocal shipped
+                clean_part = _sanitize_markdown(part).strip()
+                if clean_part:
+                    sent = await msg.answer(clean_part)
+                    outbound_log.append(_outbound_row(chat_id, clean_part, "text", sent))
+                    shipped += 1
 
-            run = client.beta.threads.runs.create(
+            async with client.beta.threads.runs.stream(
                 thread_id=thread_id,
                 assistant_id=ASSISTANT_ID,
                 tool_choice="auto",
-            )
-
-            await send_log(msg.bot, f"🚀 Run {run.id} started for chat_id={chat_id}, thread={thread_id}")
-            
-            async def _release_thread_lock(lock_token):  # освобождение лока
-                if _redis and isinstance(lock_token, str):
-                    try:
-                        await _redis.delete(lock_token)  # снимаем ключ лока в Redis
-                    except Exception:
-                        pass
-                elif isinstance(lock_token, asyncio.Lock):
-                    try:
-                        lock_token.release()  # отпускаем лок в памяти процесса
-                    except Exception:
-                        pass
-
-
-            # 🔴 Мониторинг статуса
-            started = time.time()
-            while True:
-                run = client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run.id)
-                if run.status in {"completed", "failed", "requires_action", "cancelled", "expired"}:
-                    break
-                await asyncio.sleep(OPENAI_RUN_POLL_INTERVAL_SEC)  # 🔴
-                if time.time() - started > OPENAI_RUN_TIMEOUT_SEC:  # 🔴
+            ) as stream:
+                try:
+                    tail = await asyncio.wait_for(
+                        _collect_text_deltas(stream, deltas, _ship),
+                        timeout=OPENAI_RUN_TIMEOUT_SEC,  # 🔴
+                    )
+                    run = await stream.get_final_run()  # итоговый статус run
+                except asyncio.TimeoutError:
+                    run = stream.current_run  # run завис — отменяем его
+                    if run is None:
+                        raise RuntimeError("Run did not start before timeout")
                     try:
-                        client.beta.threads.runs.cancel(thread_id=thread_id, run_id=run.id)
+                        await client.beta.threads.runs.cancel(thread_id=thread_id, run_id=run.id)
                     except Exception:
                         pass
-                    break
 
-            typing_task.cancel()  # 🔴 стоп typing при завершении
+            send_log_nowait(msg.bot, f"🚀 Run {run.id} streamed for chat_id={chat_id}, thread={thread_id}, status={run.status}")
         finally:
-            await _release_thread_lock(lock_token)
+            typing_task.cancel()  # 🔴 стоп typing при завершении (и при ошибке)
+            await _release_thread_lock(thread_id, lock_token)
 
         # 🔴 Ответ пользователю
         if run.status == "completed":
-            msgs = client.beta.threads.messages.list(thread_id=thread_id, order="desc", limit=2)
-            raw_txt = _first_text(msgs)
+            raw_txt = "".join(deltas)  # текст уже пришёл в стриме
+            if not raw_txt:  # на всякий случай — из истории треда
+                msgs = await client.beta.threads.messages.list(thread_id=thread_id, order="desc", limit=1)  # после completed run последним идёт ответ ассистента
+                raw_txt = _first_text(msgs)
             if not raw_txt:
                 raise RuntimeError("Empty response from assistant")
 
             clean = _sanitize_markdown(raw_txt)
-            chunks = _split_for_delivery(clean) or [clean]
-
-            # первая часть
-            typing_task = asyncio.create_task(
-                _typing_for(msg.bot, chat_id, TELEGRAM_TYPING_RESPONSE_DURATION_SEC)
-            )  # 🔴
-            resp = await msg.answer(chunks[0])
-            typing_task.cancel()
-            save_message(chat_id, 1, chunks[0], "text", None, getattr(resp, "message_id", None))
-
-            # --- Дублируем ответ ассистента в amoCRM чат --- 🔴 ВСТАВЬ СЮДА
-            # openai_client.py — у вас уже добавлено рядом с отправкой ответа в ТГ  # 🔴
+            if shipped:  # начало ответа уже у пользователя — досылаем только хвост
+                chunks = _split_for_delivery(_sanitize_markdown(tail))
+            else:
+                chunks = _split_for_delivery(clean) or [clean]
+
+            # части крупные и их мало — без TYPING между ними
+            for part in chunks:
+                resp = await msg.answer(part)
+                outbound_log.append(_outbound_row(chat_id, part, "text", resp))
+
+            # --- Дублируем ответ ассистента в amoCRM чат (целиком) --- 🔴
             try:
                 from amo_client import send_chat_message_v2  # 🔴
                 await send_chat_message_v2(
@@ -476,21 +621,27 @@ async def schedule_processing(msg: Message, delay_sec: Optional[int] = None) ->
                 )
             except Exception as e:
                 logging.warning("⚠️ Failed to send assistant reply to amoCRM: %s", e)
-
-            # остальные части
-            for tail_part in chunks[1:]:
-                typing_task = asyncio.create_task(
-                    _typing_for(msg.bot, chat_id, TELEGRAM_TYPING_TAIL_DURATION_SEC)
-                )  # 🔴
-                respN = await msg.answer(tail_part)
-                typing_task.cancel()
-                save_message(chat_id, 1, tail_part, "text", None, getattr(respN, "message_id", None))
             return
 
         # если не completed
         await msg.answer("⚠️ Ошибка обработки. Попробуйте позже.")
-        await send_log(msg.bot, f"run {run.id} finished with status={run.status}")
+        send_log_nowait(msg.bot, f"run {run.id} finished with status={run.status}")
         _log_run_error(run)
     except Exception as e:
+        if prep is not None:
+            if not prep.done():
+                prep.cancel()  # не оставляем висеть загрузку вложения
+            elif not prep.cancelled() and prep.exception() is not None:
+                # упала раньше, чем до неё дошли: забираем ошибку, иначе
+                # asyncio напишет «Task exception was never retrieved»
+                logging.warning("⚠️ Attachment prep failed: %s", prep.exception())
+        if typing_task is not None:
+            typing_task.cancel()  # например, если не удалось взять лок
         await msg.answer("⚠️ Внутренняя ошибка. Пожалуйста, повторите позже.")
-        await send_log(msg.bot, f"exception: {e}\n{traceback.format_exc()}")
+        send_log_nowait(msg.bot, f"exception: {e}\n{traceback.format_exc()}")
+    finally:
+        if outbound_log:  # 🔴 один INSERT на весь ответ, в потоке — не блокируем цикл
+            try:
+                await asyncio.to_thread(save_messages_bulk, outbound_log)
+            except Exception as e:
+                logging.warning("⚠️ Failed to save outbound messages: %s", e)
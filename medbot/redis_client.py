@@ -0,0 +1,37 @@
+# redis_client.py
+# Клиенты Redis на процесс: один пул соединений вместо отдельного from_url
+# в каждом модуле. ar — асинхронный, для кода в event loop (storage.py);
+# r — синхронный, для потоков (repo.py, фоновые задачи через to_thread).
+import os  # os — окружение
+import redis  # библиотека Redis
+import redis.asyncio as aioredis  # асинхронный клиент (не блокирует loop)
+
+# берём адрес Redis из переменных окружения; по умолчанию — локальный
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+
+# общий пул; строки вместо байтов упрощают работу # 🔴
+pool = redis.ConnectionPool.from_url(
+    REDIS_URL,
+    decode_responses=True,
+    # 🔴 верхняя граница сокетов
+    max_connections=int(os.getenv("REDIS_POOL", "50")),
+)
+# импортируйте его: from redis_client import r
+r = redis.Redis(connection_pool=pool)
+
+# асинхронный клиент — свой пул (сокеты asyncio нельзя делить с потоками).
+# Blocking: локи тредов держат соединение в BLPOP — при пике ждём
+# свободное соединение, а не падаем с «Too many connections» # 🔴
+apool = aioredis.BlockingConnectionPool.from_url(
+    REDIS_URL,
+    decode_responses=True,
+    max_connections=int(os.getenv("REDIS_POOL", "50")),
+)
+# from redis_client import ar; await ar.hget(...)
+ar = aioredis.Redis(connection_pool=apool)
+
+
+async def close_redis() -> None:
+    """Закрываем асинхронный пул на shutdown."""
+    await ar.aclose()
+    await apool.disconnect()
@@ -2,81 +2,294 @@
 from __future__ import annotations  # аннотации без кавычек в 3.9+
 
 # стандартная библиотека
+import asyncio  # очередь фоновой записи
+import json  # кэш сводки в Redis
+import logging  # логи воркера
+import uuid  # уникальные ключи снимков счётчиков
 from datetime import datetime, timedelta, timezone  # работа со временем
-from typing import Optional, List, Dict, Any  # типы для подсказок
+from typing import (  # типы для подсказок
+    Optional, List, Dict, Any, BinaryIO, Tuple, Union,
+)
 
 # сторонние пакеты
-from sqlalchemy import select, and_, desc  # конструкторы запросов
-from sqlalchemy.sql import func, case  # агрегаты и условные выражения
+from sqlalchemy import select, and_, desc, delete, lambda_stmt  # конструкторы запросов
+from sqlalchemy.sql import func  # агрегаты
+from sqlalchemy.dialects.postgresql import insert as pg_insert  # INSERT ... ON CONFLICT
 
 # локальные модули проекта
-from db import SessionLocal, User, Message  # сессия и ORM-модели
-import redis
-from constants import REDIS_LEAD_ID_KEY  # 🔴 единый ключ Redis
+from db import SessionLocal, User, Message, MsgcountSnapshot, engine  # сессия, ORM-модели, движок
+from redis_client import r  # 🔴 общий клиент Redis (один пул на процесс)
+# связка chat_id ↔ lead_id живёт в storage
+# (реэкспорт get_lead_id/set_lead_id — для старых импортов из repo)
+from storage import get_lead_id, set_lead_id  # noqa: F401
+from constants import (  # 🔴 единый ключ Redis и лимиты записи
+    REDIS_USERS_HLL_PREFIX,
+    REDIS_USER_MSGCOUNT_KEY,
+    REDIS_MSGCOUNT_LOCK_KEY,
+    REDIS_MSGCOUNT_SNAPSHOTS_KEY,
+    MSGCOUNT_RECONCILE_LOCK_TTL_SEC,
+    USERS_HLL_TTL_SEC,
+    USERS_HLL_MAX_DAYS,
+    REDIS_ANALYTICS_PREFIX,
+    ANALYTICS_CACHE_TTL_SEC,
+    ANALYTICS_CACHE_CLOSED_TTL_SEC,
+    DB_WRITE_QUEUE_MAXSIZE,
+    DB_WRITE_BATCH_MAX,
+    DB_WRITE_LINGER_SEC,
+)
+
+
+_MSG_TBL = Message.__table__  # таблица messages для Core-вставок
+_SNAPSHOT_TBL = MsgcountSnapshot.__table__  # применённые снимки счётчиков
 
 
 # ==========================
 # Помощники по пользователю
 # ==========================
 
-def upsert_user_from_msg(msg) -> None:
-    """Создаём/обновляем пользователя по входящему сообщению.
-    Стратегия: одна транзакция; если записи нет — вставляем, иначе
-    мягко обновляем основные поля и счётчик сообщений.
+def _user_row(msg, now: datetime) -> Dict[str, Any]:
+    """Строка users по входящему сообщению (для multi-row UPSERT)."""
+    fu = msg.from_user  # автор сообщения (может отсутствовать)
+    return {
+        "chat_id": msg.chat.id,  # внешний идентификатор TG
+        "username": getattr(fu, "username", None),  # ник
+        "first_name": getattr(fu, "first_name", None),  # имя
+        "last_name": getattr(fu, "last_name", None),  # фам.
+        "language_code": getattr(fu, "language_code", None),  # язык TG
+        "first_seen_at": now,  # впервые увидели
+        "last_seen_at": now,  # последнее «видели»
+        "messages_total": 0,  # счёт придёт из Redis при сверке
+    }
+
+
+def _upsert_users(conn, msgs: List[Any], now: datetime) -> None:
+    """Создаём/обновляем пользователей по входящим сообщениям пачки.
+    Стратегия: multi-row INSERT ... ON CONFLICT (chat_id) DO UPDATE —
+    без предварительного SELECT. Счётчик сообщений в строке не трогаем:
+    HINCRBY в Redis (_count_user_messages), а в users.messages_total
+    его пачкой переносит reconcile_message_counts.
     """
-    with SessionLocal() as s:  # открываем короткую сессию на оперцию
-        q = select(User).where(User.chat_id == msg.chat.id)  # ищем по chat
-        u: Optional[User] = s.execute(q).scalar_one_or_none()  # берём одну
-
-        now = datetime.now(timezone.utc)  # фиксируем «момент измерения»
-
-        if not u:  # нет записи — создаём с начальными значениями
-            u = User(
-                chat_id=msg.chat.id,  # внешний идентификатор TG
-                username=getattr(msg.from_user, "username", None),  # ник
-                first_name=getattr(msg.from_user, "first_name", None),  # имя
-                last_name=getattr(msg.from_user, "last_name", None),  # фам.
-                language_code=getattr(  # язык интерфейса TG
-                    msg.from_user, "language_code", None
-                ),
-                first_seen_at=now,  # впервые увидели
-                last_seen_at=now,  # последнее «видели»
-                messages_total=1,  # первый инкремент
-            )
-            s.add(u)  # ставим на инсерт
-        else:  # запись есть — обновляем минимально необходимое
-            u.username = getattr(msg.from_user, "username", u.username)
-            u.first_name = getattr(msg.from_user, "first_name", u.first_name)
-            u.last_name = getattr(msg.from_user, "last_name", u.last_name)
-            u.language_code = getattr(
-                msg.from_user, "language_code", u.language_code
+    latest: Dict[int, Any] = {}  # один chat_id — одна строка в UPSERT
+    for msg in msgs:
+        latest[msg.chat.id] = msg  # последнее сообщение чата выигрывает
+    known = [m for m in latest.values() if m.from_user is not None]
+    unknown = [m for m in latest.values() if m.from_user is None]
+    # профиль обновляем, только если автор известен — две группы строк
+    for group, with_profile in ((known, True), (unknown, False)):
+        if not group:
+            continue
+        stmt = pg_insert(User).values([_user_row(m, now) for m in group])
+        ex = stmt.excluded
+        updates: Dict[str, Any] = {
+            "last_seen_at": ex.last_seen_at,  # двигаем «последний визит»
+        }
+        if with_profile:
+            updates.update(
+                username=ex.username,
+                first_name=ex.first_name,
+                last_name=ex.last_name,
+                language_code=ex.language_code,
             )
-            u.last_seen_at = now  # двигаем «последний визит»
-            u.messages_total = (u.messages_total or 0) + 1  # счётчик ↑
+        conn.execute(stmt.on_conflict_do_update(
+            index_elements=[User.chat_id], set_=updates
+        ))
 
-        s.commit()  # фиксируем транзакцию
 
-
-def save_message(
-    chat_id: int,
-    direction: int,  # 0 = пользователь→бот, 1 = бот→пользователь
-    text: Optional[str] = None,
-    content_type: str = "text",
-    attachment_name: Optional[str] = None,
-    message_id: Optional[int] = None,
-) -> None:
-    """Сохраняем отдельное сообщение (любой стороны)."""
-    with SessionLocal() as s:  # короткая транзакция на запись
-        m = Message(
-            chat_id=chat_id,
-            direction=direction,
-            message_id=message_id,
-            text=text,
-            content_type=content_type,
-            attachment_name=attachment_name,
+def _count_user_messages(msgs: List[Any]) -> None:
+    """HINCRBY счётчиков сообщений — O(1), без блокировки строки users."""
+    if not msgs:
+        return
+    try:
+        with r.pipeline(transaction=False) as p:  # один round-trip
+            for msg in msgs:
+                p.hincrby(REDIS_USER_MSGCOUNT_KEY, msg.chat.id, 1)  # 🔴
+            p.execute()
+    except Exception as e:  # счётчики не должны ломать запись сообщений
+        logging.warning("⚠️ Message counters update failed: %s", e)
+
+
+# снимать замок только своим токеном (замок мог истечь и достаться другому)
+_UNLOCK_SCRIPT = r.register_script(
+    "if redis.call('get', KEYS[1]) == ARGV[1] then "
+    "return redis.call('del', KEYS[1]) end return 0"
+)
+
+# RENAME живого хэша в снимок + SADD в реестр снимков — атомарно:
+# снимок не может «потеряться» между переименованием и записью в реестр
+_SNAPSHOT_SCRIPT = r.register_script(
+    "if redis.call('exists', KEYS[1]) == 0 then return 0 end "
+    "redis.call('rename', KEYS[1], KEYS[2]) "
+    "redis.call('sadd', KEYS[3], KEYS[2]) return 1"
+)
+
+
+def _apply_msgcount_snapshot(snapshot: str) -> int:
+    """Прибавляет снимок счётчиков к users.messages_total ровно один раз.
+    Имя снимка пишется в msgcount_snapshots в той же транзакции, что и
+    прибавка: если снимок уже применён (упали после COMMIT, не успев
+    удалить его из Redis), прибавка пропускается. Снимок удаляется из
+    Redis только после COMMIT, затем стирается и его строка-отметка.
+    """
+    counts = r.hgetall(snapshot)
+    applied = 0
+    if counts:
+        stmt = pg_insert(User).values(
+            [{"chat_id": int(cid), "messages_total": int(n)}
+             for cid, n in counts.items()]
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[User.chat_id],
+            set_={"messages_total": User.messages_total
+                  + stmt.excluded.messages_total},
+        )
+        mark = pg_insert(_SNAPSHOT_TBL).values(
+            snapshot=snapshot
+        ).on_conflict_do_nothing()
+        with engine.begin() as conn:  # отметка и прибавка — один COMMIT
+            if conn.execute(mark).rowcount:  # снимок ещё не применялся
+                conn.execute(stmt)
+                applied = len(counts)
+    with r.pipeline() as p:  # MULTI: снимок и запись в реестре — вместе
+        p.delete(snapshot)
+        p.srem(REDIS_MSGCOUNT_SNAPSHOTS_KEY, snapshot)
+        p.execute()
+    # снимка в Redis больше нет — отметка не нужна (таблица не растёт)
+    with engine.begin() as conn:
+        conn.execute(
+            delete(_SNAPSHOT_TBL).where(_SNAPSHOT_TBL.c.snapshot == snapshot)
         )
-        s.add(m)  # ставим на инсерт
-        s.commit()  # фиксируем
+    return applied
+
+
+def reconcile_message_counts() -> int:
+    """Переносит накопленные в Redis счётчики в users.messages_total.
+    Один сверщик на все процессы (замок SET NX EX). Хэш атомарно
+    переименовывается в снимок с уникальным ключом и заносится в реестр
+    снимков (SET), затем одним INSERT ... ON CONFLICT прибавляется к
+    строкам. Снимки, оставшиеся в реестре от упавших прогонов,
+    подхватываются первыми. Возвращает число обновлённых пользователей.
+    """
+    token = uuid.uuid4().hex
+    if not r.set(
+        REDIS_MSGCOUNT_LOCK_KEY, token,
+        nx=True, ex=MSGCOUNT_RECONCILE_LOCK_TTL_SEC,
+    ):
+        return 0  # сверку уже делает другой процесс
+    try:
+        # новые HINCRBY пойдут в свежий хэш
+        _SNAPSHOT_SCRIPT(keys=[
+            REDIS_USER_MSGCOUNT_KEY,
+            f"{REDIS_USER_MSGCOUNT_KEY}:reconcile:{token}",
+            REDIS_MSGCOUNT_SNAPSHOTS_KEY,
+        ])
+        snapshots = r.smembers(REDIS_MSGCOUNT_SNAPSHOTS_KEY)  # вкл. хвосты сбоев
+        return sum(_apply_msgcount_snapshot(k) for k in sorted(snapshots))
+    finally:
+        _UNLOCK_SCRIPT(keys=[REDIS_MSGCOUNT_LOCK_KEY], args=[token])
+
+
+def save_messages_bulk(rows: List[Dict[str, Any]]) -> None:
+    """Сохраняем пачку сообщений одним multi-row INSERT.
+    rows — словари с колонками messages (chat_id, direction, text, ...).
+    """
+    if not rows:
+        return
+    # Core-вставка без ORM-сессии: ни identity map, ни объектов Message
+    with engine.begin() as conn:  # одна транзакция на всю пачку, commit при выходе
+        conn.execute(_MSG_TBL.insert(), rows)  # executemany → один INSERT
+
+
+# ==========================
+# Фоновая запись в БД
+# ==========================
+
+# ("user", msg) | ("message", dict для save_messages_bulk)
+_DB_Q: asyncio.Queue = asyncio.Queue(maxsize=DB_WRITE_QUEUE_MAXSIZE)
+
+
+def enqueue_db_write(kind: str, payload: Any) -> None:
+    """Ставит запись в очередь БД; хэндлер не ждёт базу."""
+    try:
+        _DB_Q.put_nowait((kind, payload))
+    except asyncio.QueueFull:  # не теряем события: дождёмся места в фоне
+        asyncio.create_task(_DB_Q.put((kind, payload)))
+
+
+def _flush_rows_one_by_one(
+    users: List[Any], rows: List[Dict[str, Any]], now: datetime
+) -> Tuple[List[Any], List[Dict[str, Any]]]:
+    """Повтор упавшей пачки поштучно: теряем только сбойные записи.
+    Возвращает то, что удалось записать.
+    """
+    users_ok: List[Any] = []
+    for msg in users:
+        try:
+            with engine.begin() as conn:
+                _upsert_users(conn, [msg], now)
+            users_ok.append(msg)
+        except Exception as e:
+            logging.warning("⚠️ User upsert dropped (chat %s): %s",
+                            msg.chat.id, e)
+    rows_ok: List[Dict[str, Any]] = []
+    for row in rows:
+        try:
+            with engine.begin() as conn:
+                conn.execute(_MSG_TBL.insert(), [row])
+            rows_ok.append(row)
+        except Exception as e:
+            logging.warning("⚠️ Message row dropped (chat %s): %s",
+                            row.get("chat_id"), e)
+    return users_ok, rows_ok
+
+
+def _flush_db_batch(batch: List[Tuple[str, Any]]) -> None:
+    """Пишет пачку одной транзакцией: сначала пользователи (FK), затем
+    сообщения. Если транзакция упала — повторяет поштучно.
+    """
+    now = datetime.now(timezone.utc)  # одна метка времени на всю пачку
+    users = [payload for kind, payload in batch if kind == "user"]
+    rows = [payload for kind, payload in batch if kind != "user"]
+    try:
+        with engine.begin() as conn:  # один COMMIT на всю пачку
+            _upsert_users(conn, users, now)
+            if rows:
+                conn.execute(_MSG_TBL.insert(), rows)  # executemany
+    except Exception as e:
+        logging.warning("⚠️ DB batch write failed, retrying one by one: %s", e)
+        users, rows = _flush_rows_one_by_one(users, rows, now)
+    _count_user_messages(users)
+    _track_active_users(rows, now)  # дневные HLL для приблизительной аналитики
+
+
+async def db_write_worker() -> None:
+    """Фоновый писатель: собирает до DB_WRITE_BATCH_MAX записей за раз
+    (или сколько придёт за DB_WRITE_LINGER_SEC) и выполняет их
+    в отдельном потоке, не блокируя event loop.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await _DB_Q.get()]  # ждём первую запись
+        # добираем накопившееся и то, что придёт за DB_WRITE_LINGER_SEC:
+        # один коммит на пачку вместо коммита на каждое сообщение
+        deadline = loop.time() + DB_WRITE_LINGER_SEC
+        while len(batch) < DB_WRITE_BATCH_MAX:
+            if not _DB_Q.empty():
+                batch.append(_DB_Q.get_nowait())
+                continue
+            left = deadline - loop.time()
+            if left <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(_DB_Q.get(), left))
+            except asyncio.TimeoutError:
+                break
+        try:
+            await asyncio.to_thread(_flush_db_batch, batch)
+        except Exception as e:  # воркер не должен умирать
+            logging.warning("⚠️ DB batch write failed: %s", e)
+        finally:
+            for _ in batch:
+                _DB_Q.task_done()
 
 
 # ==========================
@@ -255,36 +468,127 @@ def analytics_summary(period: str = "day") -> Dict[str, int]:
 # Агрегаты за произвольный период
 # ==========================
 
+def _users_hll_keys(
+    date_from: datetime, date_to: datetime
+) -> List[str]:
+    """Ключи дневных HyperLogLog (UTC) для окна [date_from, date_to)."""
+    day = date_from.astimezone(timezone.utc).date()
+    last = (date_to - timedelta(microseconds=1)).astimezone(timezone.utc).date()
+    keys: List[str] = []
+    while day <= last and len(keys) < USERS_HLL_MAX_DAYS:
+        keys.append(f"{REDIS_USERS_HLL_PREFIX}{day:%Y%m%d}")
+        day += timedelta(days=1)
+    return keys
+
+
+def _track_active_users(rows: List[Dict[str, Any]], now: datetime) -> None:
+    """PFADD chat_id входящих сообщений в HyperLogLog текущего дня (UTC)."""
+    chat_ids = {row["chat_id"] for row in rows if row.get("direction") == 0}
+    if not chat_ids:
+        return
+    key = f"{REDIS_USERS_HLL_PREFIX}{now:%Y%m%d}"
+    try:
+        with r.pipeline(transaction=False) as p:  # один round-trip
+            p.pfadd(key, *chat_ids)
+            p.expire(key, USERS_HLL_TTL_SEC)
+            p.execute()
+    except Exception as e:  # аналитика не должна ломать запись сообщений
+        logging.warning("⚠️ HLL users tracking failed: %s", e)
+
+
 def get_analytics_summary(  # новая универсальная функция
     date_from: Optional[datetime],  # включительно
     date_to: Optional[datetime],    # исключительно
+    approx_users: bool = False,     # users_total через HyperLogLog
+) -> Dict[str, int]:
+    """Сводка за [date_from, date_to) с коротким кэшем в Redis.
+    Дашборды опрашивают сводку часто — небольшая задержка данных
+    допустима, а повторный скан messages нет. Закрытое окно в прошлом
+    уже не изменится, его держим в кэше долго.
+    """
+    # окно закончилось больше минуты назад — данные уже не изменятся
+    # (запас на фоновую пачечную запись сообщений)
+    settled = datetime.now(timezone.utc) - timedelta(minutes=1)
+    closed = date_to is not None and date_to <= settled
+    if closed:
+        # живёт сутки — только точные границы, без склейки соседних окон
+        bounds = (
+            f"exact:{date_from.timestamp() if date_from else 0}:"
+            f"{date_to.timestamp()}"
+        )
+    else:
+        # скользящие окна «до сейчас» (week/month) округляем до TTL:
+        # между обновлениями они попадают в один и тот же ключ
+        step = ANALYTICS_CACHE_TTL_SEC
+        bounds = (
+            f"{int(date_from.timestamp()) // step if date_from else 0}:"
+            f"{int(date_to.timestamp()) // step if date_to else 0}"
+        )
+    key = f"{REDIS_ANALYTICS_PREFIX}{bounds}:{int(approx_users)}"
+    try:
+        cached = r.get(key)
+        if cached:
+            return json.loads(cached)
+    except Exception as e:  # Redis недоступен — просто считаем из БД
+        logging.warning("⚠️ Analytics cache read failed: %s", e)
+
+    result = _compute_analytics_summary(date_from, date_to, approx_users)
+
+    try:
+        r.set(
+            key,
+            json.dumps(result),
+            ex=ANALYTICS_CACHE_CLOSED_TTL_SEC if closed else ANALYTICS_CACHE_TTL_SEC,
+        )
+    except Exception as e:
+        logging.warning("⚠️ Analytics cache write failed: %s", e)
+    return result
+
+
+def _compute_analytics_summary(
+    date_from: Optional[datetime],
+    date_to: Optional[datetime],
+    approx_users: bool = False,
 ) -> Dict[str, int]:
     """Сводка по сообщениям за [date_from, date_to).
-    Стратегия: один SELECT с агрегатами и CASE, чтобы не гонять
-    несколько отдельных COUNT-ов. Границы None — без ограничения.
+    Стратегия: один SELECT с агрегатами (COUNT ... FILTER), чтобы не
+    гонять несколько отдельных COUNT-ов. Границы None — без ограничения.
+    Запрос собран через lambda_stmt: SQL компилируется один раз на
+    форму запроса, дальше меняются только параметры границ.
+    approx_users (при обеих границах): уникальных пользователей
+    считает PFCOUNT по дневным HLL (~0.8% погрешности, окно — целыми
+    днями UTC) вместо COUNT(DISTINCT chat_id) по всем строкам окна.
     """
+    users_total: Optional[int] = None
+    if approx_users and date_from is not None and date_to is not None:
+        keys = _users_hll_keys(date_from, date_to)
+        users_total = int(r.pfcount(*keys)) if keys else 0
+
     with SessionLocal() as s:  # одна сессия на агрегацию
-        stmt = select(  # собираем единый агрегирующий запрос
+        stmt = lambda_stmt(lambda: select(  # единый агрегирующий запрос
             func.count(Message.id).label("messages_total"),
-            func.sum(
-                case((Message.direction == 0, 1), else_=0)
-            ).label("messages_in"),
-            func.sum(
-                case((Message.direction == 1, 1), else_=0)
-            ).label("messages_out"),
-            func.count(func.distinct(Message.chat_id)).label(
-                "users_total"
-            ),
-        )
+            # COUNT(*) FILTER (WHERE ...) — Postgres-агрегат без CASE
+            func.count().filter(Message.direction == 0).label("messages_in"),
+            func.count().filter(Message.direction == 1).label("messages_out"),
+        ))
+        if users_total is None:  # точный подсчёт — в том же SELECT
+            stmt += lambda q: q.add_columns(
+                func.count(func.distinct(Message.chat_id)).label(
+                    "users_total"
+                )
+            )
         if date_from is not None:  # нижняя граница, если задана
-            stmt = stmt.where(Message.created_at >= date_from)
+            stmt += lambda q: q.where(Message.created_at >= date_from)
         if date_to is not None:  # верхняя граница, если задана
-            stmt = stmt.where(Message.created_at < date_to)
+            stmt += lambda q: q.where(Message.created_at < date_to)
 
         row = s.execute(stmt).one()  # выполняем и читаем строку
 
+        if users_total is None:
+            users_total = int(row.users_total or 0)
+
         return {  # нормализуем None → 0 и приводим к int
-            "users_total": int(row.users_total or 0),
+            "users_total": users_total,
             "messages_total": int(row.messages_total or 0),
             "messages_in": int(row.messages_in or 0),
             "messages_out": int(row.messages_out or 0),
@@ -295,69 +599,55 @@ def get_analytics_summary(  # новая универсальная функци
 # ==========================
 
 import aiohttp
-import logging
 import os
 
+from amo_client import get_session  # общий пул соединений amoCRM
+
 
 AMO_API_URL = os.getenv("AMO_API_URL", "")
 AMO_ACCESS_TOKEN = os.getenv("AMO_ACCESS_TOKEN", "")
 
 
-async def upload_file_to_amo(file_name: str, file_bytes: bytes) -> Optional[str]:
+async def upload_file_to_amo(
+    file_name: str, file_obj: Union[bytes, BinaryIO]
+) -> Optional[str]:
     """
     Загружает файл в amoCRM и возвращает UUID загруженного файла.
     Используется при создании сделок из Telegram.
+    file_obj — байты или файловый объект (BytesIO из aiogram): его
+    aiohttp отправляет потоково, без лишней копии в bytes.
     """
     try:
-        # создаём HTTP-сессию
-        async with aiohttp.ClientSession() as session:
-            # готовим форму multipart/form-data
-            form = aiohttp.FormData()
-            form.add_field(
-                "file",
-                file_bytes,
-                filename=file_name,
-                content_type="application/octet-stream",
-            )
+        # берём общую HTTP-сессию amoCRM (keep-alive)
+        session = await get_session()
+        # готовим форму multipart/form-data
+        form = aiohttp.FormData()
+        form.add_field(
+            "file",
+            file_obj,
+            filename=file_name,
+            content_type="application/octet-stream",
+        )
 
-            # отправляем POST-запрос в amoCRM API
-            async with session.post(
-                f"{AMO_API_URL}/api/v4/files",
-                headers={"Authorization": f"Bearer {AMO_ACCESS_TOKEN}"},
-                data=form,
-            ) as resp:
-                if resp.status == 200:
-                    # читаем JSON и возвращаем UUID файла
-                    data = await resp.json()
-                    uuid = data.get("uuid")
-                    logging.info(f"✅ File uploaded to amoCRM: {file_name}")
-                    return uuid
-                else:
-                    # ошибка на стороне amoCRM — логируем
-                    text = await resp.text()
-                    logging.warning(
-                        f"⚠️ Failed to upload file [{resp.status}]: {text}"
-                    )
-                    return None
+        # отправляем POST-запрос в amoCRM API
+        async with session.post(
+            f"{AMO_API_URL}/api/v4/files",
+            headers={"Authorization": f"Bearer {AMO_ACCESS_TOKEN}"},
+            data=form,
+        ) as resp:
+            if resp.status == 200:
+                # читаем JSON и возвращаем UUID файла
+                data = await resp.json()
+                uuid = data.get("uuid")
+                logging.info(f"✅ File uploaded to amoCRM: {file_name}")
+                return uuid
+            else:
+                # ошибка на стороне amoCRM — логируем
+                text = await resp.text()
+                logging.warning(
+                    f"⚠️ Failed to upload file [{resp.status}]: {text}"
+                )
+                return None
     except Exception as e:
         logging.warning(f"⚠️ upload_file_to_amo exception: {e}")
         return None
-
-# ==========================
-# Связка chat_id ↔ lead_id (Redis)
-# ==========================
-
-# 🔴 эти функции нужны для умной привязки сделок к пользователя
-
-REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
-r = redis.from_url(REDIS_URL, decode_responses=True)
-
-
-def set_lead_id(chat_id: int, lead_id: str) -> None:
-    """Привязывает chat_id → lead_id для повторного использования."""  # 🔴
-    r.hset(REDIS_LEAD_ID_KEY, chat_id, lead_id)  # 🔴
-
-
-def get_lead_id(chat_id: int) -> Optional[str]:
-    """Возвращает связанный lead_id, если есть."""  # 🔴
-    return r.hget(REDIS_LEAD_ID_KEY, chat_id)  # 🔴
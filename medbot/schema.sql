@@ -27,10 +27,24 @@ CREATE TABLE IF NOT EXISTS messages (
   created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
 );
 
-CREATE INDEX IF NOT EXISTS idx_messages_chat_created ON messages (chat_id, created_at DESC);
-CREATE INDEX IF NOT EXISTS idx_messages_created ON messages (created_at DESC);
+-- история и счётчики по чату; direction в INCLUDE — фильтры направления по чату идут index-only
+CREATE INDEX IF NOT EXISTS idx_messages_chat_created_dir ON messages (chat_id, created_at DESC) INCLUDE (direction);
+DROP INDEX IF EXISTS idx_messages_chat_created;  -- заменён индексом выше
 CREATE INDEX IF NOT EXISTS idx_messages_in ON messages (chat_id) WHERE direction = 0;
 CREATE INDEX IF NOT EXISTS idx_messages_out ON messages (chat_id) WHERE direction = 1;
+-- сводка аналитики (get_analytics_summary): фильтр по created_at, агрегаты по direction и chat_id —
+-- покрывающий индекс позволяет index-only scan без чтения строк таблицы
+CREATE INDEX IF NOT EXISTS idx_messages_created_chat_dir ON messages (created_at, chat_id, direction);
+DROP INDEX IF EXISTS idx_messages_created;  -- покрыт индексом выше (сортировка DESC — обратным сканом)
+-- входящие за период (HLL-путь и фильтры направления в админке)
+CREATE INDEX IF NOT EXISTS idx_messages_in_created ON messages (created_at, chat_id) WHERE direction = 0;
+
+-- msgcount_snapshots: снимки счётчиков из Redis, уже прибавленные к users.messages_total
+-- (reconcile_message_counts: строка пишется в одной транзакции с прибавкой — повтор не удвоит счёт)
+CREATE TABLE IF NOT EXISTS msgcount_snapshots (
+  snapshot TEXT PRIMARY KEY,
+  applied_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
 
 -- user_daily_stats: агрегаты по дням
 CREATE TABLE IF NOT EXISTS user_daily_stats (
@@ -1,80 +1,303 @@
 # storage.py
-import os  # os — окружение
 import time  # time — метки времени
 import redis  # библиотека Redis
-from typing import Optional, Dict
+from cachetools import TTLCache  # кэш в памяти процесса с TTL
+from typing import Iterable, List, Optional, Tuple
 from constants import (  # 🔴 централизованные ключи и префиксы
     REDIS_THREAD_KEY,  # 🔴
     REDIS_LAST_SEEN_KEY,  # 🔴
+    REDIS_LAST_SEEN_RESTAMPED_KEY,  # 🔴
     REDIS_ACK_ONCE_PREFIX,  # 🔴
     REDIS_LAST_ACK_PREFIX,  # 🔴
+    REDIS_ACK_ONCE_HASH_PREFIX,  # 🔴
+    REDIS_LAST_ACK_HASH_PREFIX,  # 🔴
+    ACK_HASH_BUCKET_SIZE,  # 🔴 чатов в одной корзине-хэше
     REDIS_LEAD_ID_KEY,  # 🔴
     ACK_ONCE_TTL_SEC,  # 🔴 время жизни пометки ACK
+    STORAGE_CACHE_MAXSIZE,  # 🔴 размер кэшей связок в памяти
+    STORAGE_CACHE_TTL_SEC,  # 🔴 время жизни записи в кэше
+    THREAD_GC_MAX_AGE_SEC,  # 🔴 через сколько молчания забываем тред чата
 )
 
-# берём адрес Redis из переменных окружения; по умолчанию — локальный
-REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
-
-# создаём подключение; строки вместо байтов упрощают работу # 🔴
-r = redis.from_url(
-    REDIS_URL, decode_responses=True
-)  # 🔴
+# общие клиенты Redis процесса: ar — асинхронный, для обработчиков
+# в event loop; r — синхронный, только для gc_threads
+# (идёт через asyncio.to_thread) # 🔴
+from redis_client import ar, r
 
 # ключи теперь берём из общего модуля констант
 # KEY = "medbot:tchat:thread"  # 🔴 перенесено в constants
 
-# локальный словарь времени последнего сообщения
-_last_seen: Dict[int, int] = {}
 
+# кэш в памяти процесса: связки меняются редко, а читаются на каждое событие;
+# TTL ограничивает рассинхрон, если запись сделал другой процесс
+_thread_cache: TTLCache = TTLCache(
+    maxsize=STORAGE_CACHE_MAXSIZE, ttl=STORAGE_CACHE_TTL_SEC
+)
+_lead_cache: TTLCache = TTLCache(
+    maxsize=STORAGE_CACHE_MAXSIZE, ttl=STORAGE_CACHE_TTL_SEC
+)
+
+
+async def get_thread_id(chat_id: int):
+    # получаем thread_id для чата: сначала из кэша процесса, потом из Redis
+    v = _thread_cache.get(chat_id)
+    if v is not None:
+        return v
+    v = await ar.hget(REDIS_THREAD_KEY, chat_id)  # 🔴
+    if v:
+        _thread_cache[chat_id] = v
+    return v
 
-def get_thread_id(chat_id: int):
-    # получаем thread_id для чата из Redis
-    return r.hget(REDIS_THREAD_KEY, chat_id)  # 🔴
 
+async def set_thread_id(chat_id: int, thread_id: str):
+    # сохраняем thread_id и время последней активности — один round-trip
+    _thread_cache.pop(chat_id, None)  # следующее чтение возьмёт новое значение
+    # 🔴 атомарность не нужна, только батч
+    async with ar.pipeline(transaction=False) as p:
+        p.hset(REDIS_THREAD_KEY, chat_id, thread_id)  # 🔴
+        p.hset(REDIS_LAST_SEEN_KEY, chat_id, int(time.time()))  # 🔴
+        await p.execute()
 
-def set_thread_id(chat_id: int, thread_id: str):
-    # сохраняем thread_id и время последней активности
-    r.hset(REDIS_THREAD_KEY, chat_id, thread_id)  # 🔴
-    r.hset(REDIS_LAST_SEEN_KEY, chat_id, int(time.time()))  # 🔴
 
+async def drop_thread_id(chat_id: int):
+    # удаляем связку и «последнюю активность» — один round-trip
+    _thread_cache.pop(chat_id, None)
+    async with ar.pipeline(transaction=False) as p:  # 🔴
+        p.hdel(REDIS_THREAD_KEY, chat_id)  # 🔴
+        p.hdel(REDIS_LAST_SEEN_KEY, chat_id)  # 🔴
+        await p.execute()
 
-def drop_thread_id(chat_id: int):
-    # удаляем связку и «последнюю активность»
-    r.hdel(REDIS_THREAD_KEY, chat_id)  # 🔴
-    r.hdel(REDIS_LAST_SEEN_KEY, chat_id)  # 🔴
+
+# удалить чат, только если его last_seen всё ещё старше cutoff: чат мог
+# написать между HSCAN и удалением. Возвращает удалённые chat_id.
+_GC_STALE_LUA = """
+local removed = {}
+for i = 2, #ARGV do
+    local ts = redis.call('hget', KEYS[1], ARGV[i])
+    if ts and tonumber(ts) < tonumber(ARGV[1]) then
+        redis.call('hdel', KEYS[1], ARGV[i])
+        redis.call('hdel', KEYS[2], ARGV[i])
+        removed[#removed + 1] = ARGV[i]
+    end
+end
+return removed
+"""
+_GC_STALE_SCRIPT = r.register_script(_GC_STALE_LUA)
+
+
+def _restamp_last_seen_once(now: int) -> None:
+    """
+    Раньше last_seen писался только в set_thread_id, то есть хранил время
+    создания треда, а не последней активности. Один раз (до первой
+    чистки) ставим всем текущее время: активные чаты не потеряют тред,
+    а молчащие уйдут через max_age_sec после этого.
+    """
+    if r.exists(REDIS_LAST_SEEN_RESTAMPED_KEY):
+        return
+    cursor = 0
+    while True:
+        cursor, batch = r.hscan(REDIS_LAST_SEEN_KEY, cursor, count=500)  # 🔴
+        if batch:
+            r.hset(REDIS_LAST_SEEN_KEY, mapping={cid: now for cid in batch})
+        if cursor == 0:
+            break
+    r.set(REDIS_LAST_SEEN_RESTAMPED_KEY, now)  # 🔴 только после прохода
 
 
-def ack_once(chat_id: int, ttl_seconds: int = ACK_ONCE_TTL_SEC) -> bool:  # 🔴
+def gc_threads(max_age_sec: int = THREAD_GC_MAX_AGE_SEC) -> List[int]:
+    """
+    Авточистка неактивных чатов: удаляет связку чат → тред и отметку
+    активности, если чат молчит дольше max_age_sec. Один проход HSCAN;
+    кандидаты перепроверяются и удаляются Lua-скриптом пачками.
+    Возвращает удалённые chat_id — кэш процесса чистит вызывающий
+    (forget_threads), уже в event loop.
+    Синхронная: вызывается через asyncio.to_thread, event loop не держит.
+    """
+    now = int(time.time())
+    _restamp_last_seen_once(now)
+    cutoff = now - max_age_sec
+    removed: List[int] = []
+    cursor = 0
+    while True:
+        cursor, batch = r.hscan(REDIS_LAST_SEEN_KEY, cursor, count=500)  # 🔴
+        stale = [cid for cid, ts in batch.items() if int(ts) < cutoff]
+        if stale:
+            gone = _GC_STALE_SCRIPT(
+                keys=[REDIS_LAST_SEEN_KEY, REDIS_THREAD_KEY],
+                args=[cutoff, *stale],
+            )
+            removed.extend(int(cid) for cid in gone)
+        if cursor == 0:
+            break
+    return removed
+
+
+def forget_threads(chat_ids: Iterable[int]) -> None:
+    # TTLCache не потокобезопасен — зовём из event loop, не из to_thread
+    for cid in chat_ids:
+        _thread_cache.pop(cid, None)
+
+
+# 🔴 Пометки авто-квитков: вместо ключа на каждый чат — хэши-«корзины» по
+# ACK_HASH_BUCKET_SIZE чатов (компактная listpack-кодировка в Redis) и TTL
+# на поле через HEXPIRE. HEXPIRE есть только в Redis >= 7.4 — на старом
+# сервере остаёмся на отдельных ключах с EX.
+_hash_field_ttl_ok: Optional[bool] = None  # поддерживает ли сервер HEXPIRE
+
+
+async def _hash_field_ttl() -> bool:
+    # лениво спрашиваем версию сервера один раз (не при импорте)
+    global _hash_field_ttl_ok
+    if _hash_field_ttl_ok is None:
+        try:
+            ver = str((await ar.info("server")).get("redis_version", "0"))
+        except redis.RedisError:
+            return False  # не кэшируем: спросим ещё раз при следующем вызове
+        major, minor = (tuple(int(x) for x in ver.split(".")[:2]) + (0, 0))[:2]
+        _hash_field_ttl_ok = (major, minor) >= (7, 4)
+    return _hash_field_ttl_ok
+
+
+def _ack_bucket(prefix: str, chat_id: int) -> str:
+    return f"{prefix}{chat_id // ACK_HASH_BUCKET_SIZE}"
+
+
+# SETNX с TTL на поле хэша — атомарно
+_ACK_ONCE_HASH_LUA = """
+if redis.call('hsetnx', KEYS[1], ARGV[1], '1') == 1 then
+    redis.call('hexpire', KEYS[1], ARGV[2], 'FIELDS', 1, ARGV[1])
+    return 1
+end
+return 0
+"""
+_ACK_ONCE_HASH_SCRIPT = ar.register_script(_ACK_ONCE_HASH_LUA)
+
+
+async def ack_once(  # 🔴
+    chat_id: int, ttl_seconds: int = ACK_ONCE_TTL_SEC
+) -> bool:
     """
     Проверяет, отправляли ли уже авто-квиток.
     Если ещё не отправляли — возвращает True и помечает, что отправлен.
     TTL — время хранения пометки (по умолчанию 24 часа).
     """
+    if await _hash_field_ttl():
+        key = _ack_bucket(REDIS_ACK_ONCE_HASH_PREFIX, chat_id)  # 🔴
+        return bool(await _ACK_ONCE_HASH_SCRIPT(
+            keys=[key], args=[chat_id, ttl_seconds]
+        ))
     key = f"{REDIS_ACK_ONCE_PREFIX}{chat_id}"  # 🔴
     # SET NX EX: записать, если не было; с TTL
-    return bool(r.set(key, "1", nx=True, ex=ttl_seconds))  # 🔴
+    return bool(await ar.set(key, "1", nx=True, ex=ttl_seconds))  # 🔴
+
+
+# Проверка кулдауна авто-квитка и запись нового времени —
+# атомарно, за один round-trip
+_SHOULD_ACK_LUA = """
+local v = redis.call('get', KEYS[1])
+if (not v) or (tonumber(ARGV[1]) - tonumber(v) > tonumber(ARGV[2])) then
+    redis.call('set', KEYS[1], ARGV[1], 'EX', ARGV[3])
+    return 1
+end
+return 0
+"""
+# EVALSHA с кэшем скрипта
+_SHOULD_ACK_SCRIPT = ar.register_script(_SHOULD_ACK_LUA)
+
+# то же на поле хэша-корзины (ARGV[4] — chat_id)
+_SHOULD_ACK_HASH_LUA = """
+local v = redis.call('hget', KEYS[1], ARGV[4])
+if (not v) or (tonumber(ARGV[1]) - tonumber(v) > tonumber(ARGV[2])) then
+    redis.call('hset', KEYS[1], ARGV[4], ARGV[1])
+    redis.call('hexpire', KEYS[1], ARGV[3], 'FIELDS', 1, ARGV[4])
+    return 1
+end
+return 0
+"""
+_SHOULD_ACK_HASH_SCRIPT = ar.register_script(_SHOULD_ACK_HASH_LUA)
 
 
-def should_ack(chat_id: int, cooldown_sec: int = 3600) -> bool:
+async def _should_ack_call(
+    chat_id: int,
+    cooldown_sec: int,
+    client=None,
+    now: Optional[int] = None,
+):
+    # вызов скрипта кулдауна; client=pipeline — команда уйдёт в общий батч
+    now = now or int(time.time())  # текущее время (или общее для батча)
+    # 🔴 GET+сравнение+SET на стороне Redis: два воркера не пошлют квиток дважды
+    # TTL: пометки ушедших чатов исчезают сами, а не копятся в Redis навсегда
+    ttl = max(cooldown_sec * 2, 3600)
+    if await _hash_field_ttl():
+        key = _ack_bucket(REDIS_LAST_ACK_HASH_PREFIX, chat_id)  # 🔴
+        return await _SHOULD_ACK_HASH_SCRIPT(
+            keys=[key],
+            args=[now, cooldown_sec, ttl, chat_id],
+            client=client,
+        )
+    key = f"{REDIS_LAST_ACK_PREFIX}{chat_id}"  # 🔴
+    return await _SHOULD_ACK_SCRIPT(
+        keys=[key], args=[now, cooldown_sec, ttl], client=client
+    )
+
+
+async def should_ack(chat_id: int, cooldown_sec: int = 3600) -> bool:
     """
     Решает, нужно ли снова отправить авто-квиток
     (например, "Ваш запрос принят"). Возвращает True, если прошло
     больше заданного времени (по умолчанию 1 час).
     """
-    key = f"{REDIS_LAST_ACK_PREFIX}{chat_id}"  # 🔴
-    now = int(time.time())  # текущее время
-    last = r.get(key)  # время предыдущего авто-квитка
-    if last is None or (now - int(last)) > cooldown_sec:
-        r.set(key, now)  # обновляем время последнего авто-квитка
-        return True  # можно отправить новый авто-квиток
-    return False  # рано отправлять, ждём ещё
+    return bool(await _should_ack_call(chat_id, cooldown_sec))
+
+
+async def load_chat_state(
+    chat_id: int, cooldown_sec: int = 3600
+) -> Tuple[Optional[str], Optional[str], bool]:
+    """
+    Всё, что нужно обработчику сообщения, за один round-trip:
+    (thread_id, lead_id, should_ack); заодно отмечает активность чата.
+    Значения из кэша процесса в pipeline не идут; проверка ACK
+    остаётся атомарным скриптом на сервере.
+    """
+    thread = _thread_cache.get(chat_id)
+    lead = _lead_cache.get(chat_id)
+    now = int(time.time())  # одна метка на весь батч: last_seen и кулдаун ACK
+    async with ar.pipeline(transaction=False) as p:  # 🔴
+        # 🔴 активность — для gc_threads
+        p.hset(REDIS_LAST_SEEN_KEY, chat_id, now)
+        if thread is None:
+            p.hget(REDIS_THREAD_KEY, chat_id)  # 🔴
+        if lead is None:
+            p.hget(REDIS_LEAD_ID_KEY, chat_id)  # 🔴
+        # уходит в батч, не на сервер
+        await _should_ack_call(chat_id, cooldown_sec, client=p, now=now)
+        res = await p.execute()
+    i = 1  # res[0] — ответ HSET last_seen
+    if thread is None:
+        thread = res[i]
+        i += 1
+        if thread:
+            _thread_cache[chat_id] = thread
+    if lead is None:
+        lead = res[i]
+        i += 1
+        if lead:
+            _lead_cache[chat_id] = lead
+    return thread, lead, bool(res[i])
 
 
-def get_lead_id(chat_id: int) -> Optional[str]:
-    # получаем связанную сделку amoCRM для чата
-    return r.hget(REDIS_LEAD_ID_KEY, chat_id)  # 🔴
+async def get_lead_id(chat_id: int) -> Optional[str]:
+    # получаем связанную сделку amoCRM для чата (кэш процесса → Redis)
+    v = _lead_cache.get(chat_id)
+    if v is not None:
+        return v
+    v = await ar.hget(REDIS_LEAD_ID_KEY, chat_id)  # 🔴
+    if v:
+        _lead_cache[chat_id] = v
+    return v
 
 
-def set_lead_id(chat_id: int, lead_id: str):
+async def set_lead_id(chat_id: int, lead_id: str):
     # сохраняем связку чат → сделка
-    r.hset(REDIS_LEAD_ID_KEY, chat_id, lead_id)  # 🔴
+    _lead_cache.pop(chat_id, None)
+    await ar.hset(REDIS_LEAD_ID_KEY, chat_id, lead_id)  # 🔴
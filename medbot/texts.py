@@ -12,3 +12,10 @@ ACK_DELAYED = (
     "Добрый день! Пишет врач, мне необходимо ознакомиться с вашим вопросом. "
     "Я отвечу Вам в ближайшее время."
 )
+THREAD_CHOICE_PROMPT = (
+    "Хотите продолжить текущий медицинский диалог или начать новый?\n"
+    "• Напишите: «продолжить» — чтобы общаться в текущем треде\n"
+    "• Напишите: «новый» — чтобы создать новый тред"
+)
+THREAD_CREATED = "Готово. Создан новый тред."
+THREAD_CONTINUED = "Готово. Продолжаем текущий тред."
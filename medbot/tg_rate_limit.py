@@ -0,0 +1,99 @@
+# tg_rate_limit.py
+# Ограничитель исходящих запросов к Telegram Bot API (token bucket).
+# Telegram: ~30 сообщений/сек на бота и ~1 сообщение/сек в один чат —
+# выравниваем поток заранее, а не ловим 429.
+import asyncio
+import time
+from typing import Dict
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import SendChatAction
+
+from constants import (  # 🔴 централизованные лимиты
+    TELEGRAM_GLOBAL_RPS,
+    TELEGRAM_GLOBAL_BURST,
+    TELEGRAM_PER_CHAT_RPS,
+    TELEGRAM_PER_CHAT_BURST,
+    TELEGRAM_RETRY_AFTER_ATTEMPTS,
+)
+
+_PER_CHAT_PRUNE_AT = 10_000  # когда чистить простаивающие корзины чатов
+
+
+class _TokenBucket:
+    """Корзина токенов с резервированием: токены могут уйти в минус,
+    тогда вызывающий ждёт, пока его токен «дорастёт»."""
+
+    __slots__ = ("rate", "burst", "tokens", "stamp")
+
+    def __init__(self, rate: float, burst: float) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(
+            self.burst, self.tokens + (now - self.stamp) * self.rate
+        )
+        self.stamp = now
+
+    def reserve(self, now: float) -> float:
+        """Забирает токен и возвращает, сколько секунд подождать."""
+        self._refill(now)
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def pause(self, now: float, seconds: float) -> None:
+        """Telegram попросил подождать (429 retry_after) — следующий
+        токен не раньше чем через seconds."""
+        self.tokens = -seconds * self.rate
+        self.stamp = now
+
+    def idle(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.burst
+
+
+class TelegramRateLimiter(BaseRequestMiddleware):
+    """Middleware сессии aiogram: каждый запрос бота проходит через корзины.
+    Общая корзина — на все методы; корзина чата — на всё, кроме TYPING."""
+
+    def __init__(self) -> None:
+        self._global = _TokenBucket(TELEGRAM_GLOBAL_RPS, TELEGRAM_GLOBAL_BURST)
+        self._chats: Dict[int, _TokenBucket] = {}
+
+    def _chat_bucket(self, chat_id: int, now: float) -> _TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            # не держим корзины ушедших чатов
+            if len(self._chats) >= _PER_CHAT_PRUNE_AT:
+                for cid in [c for c, b in self._chats.items() if b.idle(now)]:
+                    del self._chats[cid]
+            bucket = self._chats[chat_id] = _TokenBucket(
+                TELEGRAM_PER_CHAT_RPS, TELEGRAM_PER_CHAT_BURST
+            )
+        return bucket
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        per_chat = isinstance(chat_id, int) and not isinstance(
+            method, SendChatAction
+        )
+        for attempt in range(TELEGRAM_RETRY_AFTER_ATTEMPTS):
+            now = time.monotonic()
+            wait = self._global.reserve(now)
+            if per_chat:
+                wait = max(wait, self._chat_bucket(chat_id, now).reserve(now))
+            if wait > 0:
+                await asyncio.sleep(wait)
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                if attempt == TELEGRAM_RETRY_AFTER_ATTEMPTS - 1:
+                    raise
+                # всё же словили 429 — замораживаем общую корзину
+                # на retry_after, чтобы остальные запросы тоже
+                # подождали, и повторяем
+                self._global.pause(time.monotonic(), e.retry_after)